@@ -0,0 +1,180 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""Crunch many Fortnox huvudbok exports in one go.
+
+The exports are crunched in a pool of processes, each writing the same
+_crunched output as huvudbok.py, after which the time taken per export and
+any failures are summarised.
+
+python batch_huvudbok.py [--workers 4] 'exports/*.txt' [...]
+"""
+import argparse
+import collections
+import glob
+import os
+import re
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor
+
+from huvudbok import OUTPUT_BACKENDS, Huvudbok, LedgerCache, is_int
+
+
+def infer_year(filename):
+    """Infer the year of a Fortnox output file.
+
+    The year is taken from the "Räkenskapsår" header row if there is one,
+    else from a year in the file name, else it is the most common year of
+    the rows.
+
+    @return: the year, or None if it can not be inferred
+    """
+    with open(filename, encoding='latin-1') as f:
+        for line in f:
+            if is_int(Huvudbok.get_col(line.split('\t'), 'konto')):
+                break  # past the header rows
+            if line.startswith('Räkenskapsår'):
+                match = re.search(r'\b(\d{4})-\d\d-\d\d', line)
+                if match:
+                    return match.group(1)
+
+    match = re.search(r'(?<!\d)((?:19|20)\d\d)(?!\d)',
+                      os.path.basename(filename))
+    if match:
+        return match.group(1)
+
+    years = collections.Counter()
+    for row in Huvudbok.load_file(filename):
+        date = Huvudbok.get_col(row.split('\t'), 'datum')
+        if date and re.match(r'\d{4}-', date):
+            years[date[:4]] += 1
+    if years:
+        return years.most_common(1)[0][0]
+    return None
+
+
+def crunch_file(filename, year=None, layout='basic', output_format='tsv',
+                cache_dir=None, use_cache=True):
+    """Crunch a Fortnox output file in a worker process.
+
+    @param year: the year to crunch, inferred from the file if not given
+    @return: dict with the "file", "year", "seconds", "rows" and "bytes"
+        written, along with the "error" if crunching failed
+    """
+    start = time.perf_counter()
+    result = {'file': filename, 'year': year, 'rows': 0, 'bytes': 0,
+              'error': None}
+    try:
+        result['year'] = year = year or infer_year(filename)
+        if not year:
+            raise ValueError('Could not infer the year, give it with --year.')
+        cache = LedgerCache(cache_dir) if use_cache else None
+        huvudbok = Huvudbok(filename, year, layout, cache=cache,
+                            output_format=output_format)
+        result['rows'] = huvudbok.rows_accepted + huvudbok.rows_cached
+        result['bytes'] = huvudbok.bytes_written
+    except Exception as e:  # report any failure rather than stopping
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+        result['traceback'] = traceback.format_exc()
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def find_files(patterns):
+    """Return the files given by a list of file names or glob patterns."""
+    filenames = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern)) or [pattern]
+        filenames += [name for name in matches if name not in filenames]
+    return filenames
+
+
+def print_summary(results, seconds):
+    """Print a table of the time taken per file, along with any failures."""
+    width = max([len(result['file']) for result in results] + [4])
+    print('{:<{width}}  {:>4}  {:>9}  {:>10}  {}'.format(
+        'file', 'year', 'seconds', 'rows', 'status', width=width))
+    for result in results:
+        print('{:<{width}}  {:>4}  {:>9.3f}  {:>10,}  {}'.format(
+            result['file'], result['year'] or '-', result['seconds'],
+            result['rows'], result['error'] or 'ok', width=width))
+    failed = sum(1 for result in results if result['error'])
+    print('{} files crunched, {} failed, in {:.3f} s.'.format(
+        len(results) - failed, failed, seconds))
+
+
+def main(args):
+    filenames = find_files(args.data_files)
+    start = time.perf_counter()
+    with ProcessPoolExecutor(args.workers) as executor:
+        futures = [
+            executor.submit(
+                crunch_file, filename, args.year, args.layout,
+                args.output_format, args.cache_dir, not args.no_cache)
+            for filename in filenames]
+        results = [future.result() for future in futures]
+    if args.verbose:
+        for result in results:
+            if result['error']:
+                print(result['file'])
+                print(result['traceback'])
+    print_summary(results, time.perf_counter() - start)
+    return 1 if any(result['error'] for result in results) else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Crunch many Fortnox huvudbok exports in one go.')
+    parser.add_argument(
+        '--workers',
+        '-w',
+        help='Number of processes to use. Defaults to the number of CPUs.',
+        type=int,
+        default=os.cpu_count()
+    )
+    parser.add_argument(
+        '--year',
+        '-y',
+        help=(
+            'Year of all of the files. If not given, the year of each file '
+            'is taken from its header, its name or its rows.')
+    )
+    parser.add_argument(
+        '--layout',
+        '-l',
+        help='Output layout, see huvudbok.py. Defaults to "basic".',
+        choices=sorted(Huvudbok.LAYOUTS),
+        default='basic'
+    )
+    parser.add_argument(
+        '--output-format',
+        '-o',
+        help='Output file format, see huvudbok.py. Defaults to "tsv".',
+        choices=sorted(OUTPUT_BACKENDS),
+        default='tsv'
+    )
+    parser.add_argument(
+        '--no-cache',
+        help='Always crunch the files, ignoring and not updating the cache.',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--cache-dir',
+        help='Directory of the cache. Defaults to ~/.cache/huvudbok.'
+    )
+    parser.add_argument(
+        '--verbose',
+        '-v',
+        help='Print the traceback of any failures.',
+        action='store_true'
+    )
+    parser.add_argument(
+        'data_files',
+        help='Paths to, or glob patterns of, Fortnox huvudbok .txt files.',
+        nargs='+',
+    )
+    args = parser.parse_args()
+    if args.layout not in OUTPUT_BACKENDS[args.output_format].LAYOUTS:
+        parser.error('--output-format {} does not support --layout {}'.format(
+            args.output_format, args.layout))
+    parser.exit(main(args))
@@ -0,0 +1,323 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""Benchmark the stages of huvudbok.py.
+
+Each stage is run on a synthetic export, see generate_huvudbok.py, or on a
+given export. The throughput and peak memory use of each stage is reported.
+Results can be saved and later compared against to catch regressions.
+
+python benchmark_huvudbok.py [--save baseline.json] [--compare baseline.json]
+"""
+import argparse
+import importlib
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import huvudbok
+from generate_huvudbok import generate
+from huvudbok import Huvudbok
+
+
+def stage_fix_num(context):
+    """Convert every debet and kredit cell to float using fix_num.
+
+    This was used before to_ore and is kept for comparison.
+    """
+    values = context['amounts']
+
+    def run():
+        for value in values:
+            huvudbok.fix_num(value)
+        return len(values)
+    return run
+
+
+def stage_to_ore(context):
+    """Convert every debet and kredit cell to öre using to_ore.
+
+    Expect about the throughput of fix_num, see to_ore.
+    """
+    values = context['amounts']
+
+    def run():
+        for value in values:
+            huvudbok.to_ore(value)
+        return len(values)
+    return run
+
+
+def stage_is_int(context):
+    """Check every konto cell using is_int."""
+    values = context['konto_values']
+
+    def run():
+        for value in values:
+            huvudbok.is_int(value)
+        return len(values)
+    return run
+
+
+def stage_process_row(context):
+    """Crunch the whole file using process_row."""
+    def run():
+        Huvudbok(None, context['year']).process_file(context['filename'])
+        return context['rows']
+    return run
+
+
+def stage_numpy(context):
+    """Crunch the whole file using the numpy engine."""
+    if not huvudbok.is_available('numpy'):
+        return None
+    importlib.import_module('numpy')  # outside of the benchmark
+
+    def run():
+        Huvudbok(None, context['year'], engine='numpy').process_file_columnar(
+            context['filename'])
+        return context['rows']
+    return run
+
+
+def stage_basic_output(context):
+    """Write the crunched file using basic_output."""
+    return output_stage(context, Huvudbok.basic_output)
+
+
+def stage_fancy_output(context):
+    """Write the crunched file using fancy_output."""
+    return output_stage(context, Huvudbok.fancy_output)
+
+
+def stage_sparse_output(context):
+    """Write the crunched file using sparse_output."""
+    return output_stage(context, Huvudbok.sparse_output)
+
+
+def stage_xlsx_output(context):
+    """Write the crunched file using fancy_output to an xlsx file."""
+    if not huvudbok.is_available('xlsxwriter'):
+        return None
+    importlib.import_module('xlsxwriter')  # outside of the benchmark
+    return output_stage(context, Huvudbok.fancy_output, huvudbok.XlsxBackend)
+
+
+def stage_parquet_output(context):
+    """Write the crunched file using sparse_output to a parquet file."""
+    if not huvudbok.is_available('pyarrow'):
+        return None
+    importlib.import_module('pyarrow.parquet')  # outside of the benchmark
+    return output_stage(
+        context, Huvudbok.sparse_output, huvudbok.ParquetBackend)
+
+
+def output_stage(context, writer, backend=huvudbok.TsvBackend):
+    """Return a stage running one of the output functions.
+
+    The output is discarded, and the number of written rows reported.
+    """
+    book = Huvudbok(None, context['year'])
+    book.set_state(context['state'])
+    book.projects  # load the project mapping outside of the benchmark
+
+    def run():
+        book.last_written_row = 0
+        with backend(os.devnull) as book.out:
+            writer(book)
+        return book.last_written_row
+    return run
+
+
+STAGES = {
+    'fix_num': stage_fix_num,
+    'to_ore': stage_to_ore,
+    'is_int': stage_is_int,
+    'process_row': stage_process_row,
+    'numpy': stage_numpy,
+    'basic_output': stage_basic_output,
+    'fancy_output': stage_fancy_output,
+    'sparse_output': stage_sparse_output,
+    'xlsx_output': stage_xlsx_output,
+    'parquet_output': stage_parquet_output,
+}
+
+
+def load_context(filename, year):
+    """Read the data needed by the stages from the export."""
+    context = {
+        'filename': filename,
+        'year': year,
+        'rows': 0,
+        'konto_values': [],
+        'amounts': [],
+    }
+    for row in Huvudbok.load_file(filename):
+        cols = row.split('\t')
+        context['rows'] += 1
+        context['konto_values'].append(Huvudbok.get_col(cols, 'konto'))
+        if (Huvudbok.get_col(cols, 'datum') or '').startswith(year):
+            context['amounts'].append(Huvudbok.get_col(cols, 'debet'))
+            context['amounts'].append(Huvudbok.get_col(cols, 'kredit'))
+
+    book = Huvudbok(None, year)
+    book.process_file(filename)
+    context['state'] = book.get_state()
+    return context
+
+
+def benchmark(run, repeat):
+    """Time a stage and measure its peak memory use.
+
+    @param run: the stage function, returning the number of items processed
+    @param repeat: number of timed runs, the fastest of which is reported
+    @return: dict with items, seconds, items_per_second and peak_bytes
+    """
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        items = run()
+        seconds.append(time.perf_counter() - start)
+
+    # tracemalloc slows things down so memory is measured separately
+    tracemalloc.start()
+    run()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {
+        'items': items,
+        'seconds': min(seconds),
+        'items_per_second': items / min(seconds) if min(seconds) else 0,
+        'peak_bytes': peak,
+    }
+
+
+def print_results(results):
+    """Output the results as a table."""
+    print('{:<14} {:>10} {:>10} {:>14} {:>10}'.format(
+        'stage', 'items', 'seconds', 'items/s', 'peak MiB'))
+    for name, result in results.items():
+        print('{:<14} {:>10} {:>10.4f} {:>14,.0f} {:>10.1f}'.format(
+            name, result['items'], result['seconds'],
+            result['items_per_second'], result['peak_bytes'] / 2 ** 20))
+
+
+def compare_results(results, baseline, tolerance):
+    """Report stages which are slower than in the baseline.
+
+    @param tolerance: allowed fractional slowdown before reporting
+    @return: whether any stage regressed
+    """
+    regressed = False
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        expected = baseline[name]['items_per_second']
+        if result['items_per_second'] < expected * (1 - tolerance):
+            print('{} regressed: {:,.0f} items/s, baseline {:,.0f}'.format(
+                name, result['items_per_second'], expected))
+            regressed = True
+    return regressed
+
+
+def main(args):
+    """Run the benchmarks as given by the command line arguments."""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        filename = args.file
+        if not filename:
+            filename = os.path.join(tmp_dir, 'huvudbok.txt')
+            generate(filename, args.konto, args.ks, args.rows, args.years,
+                     args.seed)
+        context = load_context(filename, args.year)
+
+        results = {}
+        for name in args.stages or STAGES:
+            run = STAGES[name](context)
+            if run:
+                results[name] = benchmark(run, args.repeat)
+
+    print_results(results)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=4)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        if compare_results(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the stages of huvudbok.py.')
+    parser.add_argument(
+        '--file',
+        help='Fortnox huvudbok .txt file to use instead of a generated one.'
+    )
+    parser.add_argument(
+        '--year',
+        help='Year to crunch. Defaults to 2018.',
+        default='2018'
+    )
+    parser.add_argument(
+        '--rows',
+        help='Rows in the generated file. Defaults to 200000.',
+        type=int,
+        default=200000
+    )
+    parser.add_argument(
+        '--konto',
+        help='Konto in the generated file. Defaults to 150.',
+        type=int,
+        default=150
+    )
+    parser.add_argument(
+        '--ks',
+        help='Kostnadsställen in the generated file. Defaults to 40.',
+        type=int,
+        default=40
+    )
+    parser.add_argument(
+        '--years',
+        help='Years in the generated file. Defaults to 2018 and 2019.',
+        nargs='+',
+        default=['2018', '2019']
+    )
+    parser.add_argument(
+        '--seed',
+        help='Seed for generating the file.',
+        type=int,
+        default=0
+    )
+    parser.add_argument(
+        '--stages',
+        help='Stages to run. Defaults to all of them.',
+        choices=STAGES,
+        nargs='+'
+    )
+    parser.add_argument(
+        '--repeat',
+        help='Number of timed runs per stage. Defaults to 3.',
+        type=int,
+        default=3
+    )
+    parser.add_argument(
+        '--save',
+        help='Save the results as json to this file.'
+    )
+    parser.add_argument(
+        '--compare',
+        help='Compare the results to those saved in this json file.'
+    )
+    parser.add_argument(
+        '--tolerance',
+        help=(
+            'Allowed slowdown compared to --compare before failing. '
+            'Defaults to 0.2.'),
+        type=float,
+        default=0.2
+    )
+    main(parser.parse_args())
@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""Generate a synthetic Fortnox Huvudbok export.
+
+Useful for benchmarking huvudbok.py without access to real bookkeeping
+data.
+
+python generate_huvudbok.py path_to_huvudbok.txt
+"""
+import argparse
+import datetime
+import random
+
+from huvudbok import Huvudbok
+
+KONTO_NAMES = (
+    'Kassa', 'Företagskonto', 'Kundfordringar', 'Förutbetalda kostnader',
+    'Leverantörsskulder', 'Personalskatt', 'Upplupna löner',
+    'Medlemsavgifter', 'Gåvor och donationer', 'Bidrag från stiftelser',
+    'Försäljning av tjänster', 'Övriga intäkter', 'Underkonsulter',
+    'Lokalhyra', 'El för lokaler', 'Förbrukningsinventarier',
+    'Programvaror', 'Kontorsmateriel', 'Telefon', 'Mobiltelefon', 'Porto',
+    'Resekostnader', 'Hotell och logi', 'Representation',
+    'Bankkostnader', 'Redovisningstjänster', 'Övriga externa tjänster',
+    'Löner till tjänstemän', 'Arbetsgivaravgifter', 'Pensionsförsäkring',
+    'Personalrepresentation', 'Utbildning', 'Ränteintäkter',
+    'Räntekostnader', 'Valutakursförluster',
+)
+TEXTS = (
+    'Inbetalning', 'Utbetalning', 'Faktura', 'Kvitto', 'Lön',
+    'Medlemsavgift', 'Gåva via Swish', 'Bidrag', 'Resa Göteborg',
+    'Tåg Malmö-Stockholm', 'Fika möte', 'Hyra', 'Återbetalning',
+)
+
+
+def swedish_num(value):
+    """Format a number the way Fortnox does, e.g. 1 234,50."""
+    return '{:,.2f}'.format(value).replace(',', ' ').replace('.', ',')
+
+
+def generate(filename, konto=150, ks=40, rows=100000, years=None, seed=0):
+    """Write a synthetic huvudbok export.
+
+    @param filename: the file to write
+    @param konto: number of konto
+    @param ks: number of kostnadsställen
+    @param rows: approximate number of transaction rows
+    @param years: list of years to spread the transactions over, defaults
+        to the current year
+    @param seed: seed for the random generator, making the output repeatable
+    @return: number of rows written
+    """
+    rand = random.Random(seed)
+    years = years or [str(datetime.date.today().year)]
+
+    # always include the konto of any merge rules, so that they are used
+    konto_ids = set()
+    for year in years:
+        rules = Huvudbok.load_merge_rules(year)
+        konto_ids.update(rules.keys(), rules.values())
+    while len(konto_ids) < konto:
+        konto_ids.add(str(rand.randint(1000, 8999)))
+    ks_ids = ['{}{:04d}'.format(rand.choice(years)[2:], rand.randint(0, 9999))
+              for _ in range(ks)]
+
+    lines = [
+        'Wikimedia Sverige\tHuvudbok',
+        'Räkenskapsår\t{}-01-01 - {}-12-31'.format(min(years), max(years)),
+        '',
+        '\t'.join(('Konto', 'Benämning', 'KS', 'Projekt', 'Datum', 'Vernr',
+                   'Text', 'Debet', 'Kredit', 'Saldo')),
+    ]
+    written = len(lines)
+    with open(filename, 'w', encoding='latin-1') as f:
+        f.write('\n'.join(lines) + '\n')
+        for konto_id in sorted(konto_ids):
+            name = '{} {}'.format(rand.choice(KONTO_NAMES), konto_id)
+            saldo = round(rand.uniform(-50000, 50000), 2)
+            lines = ['\t'.join((
+                konto_id, name, '', '', '', '', 'Ingående balans', '', '',
+                swedish_num(saldo)))]
+            transactions = sorted(
+                ('{}-{:02d}-{:02d}'.format(
+                    rand.choice(years), rand.randint(1, 12),
+                    rand.randint(1, 28)),
+                 round(rand.lognormvariate(6, 1.5), 2))
+                for _ in range(int(rand.expovariate(konto / rows))))
+            for date, amount in transactions:
+                debet, kredit = swedish_num(amount), ''
+                if rand.random() < 0.5:
+                    debet, kredit = kredit, debet
+                    saldo -= amount
+                else:
+                    saldo += amount
+                lines.append('\t'.join((
+                    '', '', rand.choice(ks_ids) if rand.random() < 0.9 else '',
+                    '', date, 'A{}'.format(rand.randint(1, 9999)),
+                    rand.choice(TEXTS), debet, kredit, swedish_num(saldo))))
+            lines.append('\t'.join((
+                '', '', '', '', '', '', 'Utgående saldo', '', '',
+                swedish_num(saldo))))
+            f.write('\n'.join(lines) + '\n')
+            written += len(lines)
+    return written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic Fortnox huvudbok export.')
+    parser.add_argument(
+        '--konto',
+        help='Number of konto. Defaults to 150.',
+        type=int,
+        default=150
+    )
+    parser.add_argument(
+        '--ks',
+        help='Number of kostnadsställen. Defaults to 40.',
+        type=int,
+        default=40
+    )
+    parser.add_argument(
+        '--rows',
+        help='Approximate number of transaction rows. Defaults to 100000.',
+        type=int,
+        default=100000
+    )
+    parser.add_argument(
+        '--years',
+        help='Years to spread the transactions over. Defaults to this year.',
+        nargs='+'
+    )
+    parser.add_argument(
+        '--seed',
+        help='Seed for the random generator.',
+        type=int,
+        default=0
+    )
+    parser.add_argument(
+        'out_file',
+        help='Path to the .txt file to write.',
+    )
+    args = parser.parse_args()
+    rows = generate(
+        args.out_file, args.konto, args.ks, args.rows, args.years, args.seed)
+    print('Wrote {} rows to {}.'.format(rows, args.out_file))
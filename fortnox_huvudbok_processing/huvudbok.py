@@ -3,13 +3,31 @@
 """Process a Fortnox Huvudbok export.
 
 python huvudbok.py path_to_huvudbok.txt
+
+Optional requirements:
+* numpy (for `--engine numpy`)
+* xlsxwriter (for `--output-format xlsx`)
+* pyarrow (for `--output-format parquet`)
 """
 import argparse
+import array
+import bisect
+import contextlib
 import datetime
+import decimal
+import glob
+import hashlib
+import importlib.util
+import io
 import json
 import os
+import pickle
 import string
+import time
+import zlib
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 
 
 class Huvudbok(object):
@@ -24,112 +42,815 @@ class Huvudbok(object):
         'kredit': 8,  # I
     }
     KS_DEFAULT = 'saknar ks'
-
-    def __init__(self, filename, year, fancy=False):
-        """Initialise a Huvudbok."""
+    ENGINES = ('dict', 'numpy')
+    PERIODS = ('month', 'quarter')
+    LAYOUTS = {  # output layout: output file name suffix, see output
+        'basic': '',
+        'fancy': '_fancy',
+        'sparse': '_sparse',
+    }
+    PARSER_VERSION = 4  # increase whenever crunching gives new results
+    # where the merge_{year}.json and sections_{year}.json files are
+    CONFIG_DIR = os.path.dirname(os.path.abspath(__file__))
+    DEFAULT_SECTIONS = {  # used unless there is a sections_{year}.json
+        'sections': [
+            {'name': 'Balanskonton', 'start': 1000, 'end': 3000, 'hide': True},
+            {'name': 'Verksamhetsintäkter', 'start': 3000, 'end': 3900},
+            # this is actually 3520-3740 which lies inside the above range
+            {'name': 'Försäljningsintäkter (3520 + 3740)', 'start': 3900},
+            {'name': 'Övriga intäkter', 'start': 3900, 'end': 4000},
+            {'name': 'Kostnader underlevernatörer', 'start': 4000,
+             'end': 5000},
+            {'name': 'Övriga externa kostnader', 'start': 5000, 'end': 7000},
+            {'name': 'Personalkostnader', 'start': 7000, 'end': 7800},
+            {'name': 'Finansiella intäkter', 'start': 7800, 'end': 8400},
+            {'name': 'Finansiella kostnader', 'start': 8400, 'end': 8500},
+        ],
+        'sum_lines': [
+            {'name': 'Summa intäkter',
+             'sum': ['Verksamhetsintäkter',
+                     'Försäljningsintäkter (3520 + 3740)', 'Övriga intäkter'],
+             'after': 'Övriga intäkter'},
+            {'name': 'Summa kostnader',
+             'sum': ['Kostnader underlevernatörer',
+                     'Övriga externa kostnader', 'Personalkostnader'],
+             'after': 'Personalkostnader'},
+            {'name': 'Verksamhetens över-/underskott',
+             'sum': ['Summa intäkter', 'Summa kostnader'],
+             'after': 'Personalkostnader'},
+            {'name': 'Resultat',
+             'sum': ['Verksamhetens över-/underskott', 'Finansiella intäkter',
+                     'Finansiella kostnader'],
+             'after': 'Finansiella kostnader'},
+        ],
+    }
+    _section_definitions = {}  # year: loaded section definition
+    _merge_rules = {}  # year: loaded konto merge rules
+
+    def __init__(self, filename, year, layout='basic', engine='dict', jobs=1,
+                 period=None, cache=None, checkpoint=None, profile=None,
+                 output_format='tsv', drill_down=False):
+        """Initialise a Huvudbok.
+
+        @param filename: the Fortnox output file to crunch, if None the
+            Huvudbok is only set up and nothing is processed.
+        @param layout: 'basic', 'fancy' or 'sparse', see output.
+        @param engine: 'dict' to aggregate row by row (the reference
+            implementation) or 'numpy' to use the columnar engine.
+        @param jobs: number of processes among which the file is split.
+        @param period: 'month' or 'quarter' to also crunch the data per
+            period, requires the dict engine and a single process.
+        @param cache: LedgerCache in which to look for and store the crunched
+            data, if None the file is always crunched.
+        @param checkpoint: path to a checkpoint file from an earlier run, see
+            process_file_incremental. Can not be combined with a period.
+        @param profile: Profile in which to record timings and counters.
+        @param output_format: 'tsv', 'xlsx' or 'parquet', see
+            OUTPUT_BACKENDS. Parquet only supports the sparse layout.
+        @param drill_down: whether to also write a DrillDownIndex next to
+            the output.
+        """
+        if layout not in Huvudbok.LAYOUTS:
+            raise ValueError('Unknown layout: {}'.format(layout))
+        if output_format not in OUTPUT_BACKENDS:
+            raise ValueError('Unknown output format: {}'.format(output_format))
+        if layout not in OUTPUT_BACKENDS[output_format].LAYOUTS:
+            raise ValueError('The {} output does not support the {} layout.'
+                             .format(output_format, layout))
+        if engine not in Huvudbok.ENGINES:
+            raise ValueError('Unknown engine: {}'.format(engine))
+        if period and period not in Huvudbok.PERIODS:
+            raise ValueError('Unknown period: {}'.format(period))
+        if (period or checkpoint) and (engine != 'dict' or jobs > 1):
+            raise ValueError(
+                'Periods and checkpoints require the dict engine and one job.')
+        if period and checkpoint:
+            raise ValueError('Periods can not be combined with checkpoints.')
         self.year = year
+        self.engine = engine
+        self.jobs = jobs
+        self.period = period
+        self.period_books = {}  # a Huvudbok per period
+        self.cache = cache
+        self.checkpoint = checkpoint
+        self.profile = profile
+        self.output_format = output_format
+        self.drill_down = drill_down
+        self.rows_seen = 0  # rows crunched, rather than cached or reused
+        self.rows_accepted = 0  # crunched rows within the year
+        self.rows_cached = 0  # rows within the year of data from the cache
+        self.bytes_written = 0
         self.all_konto = {}
         self.konto = ''
         self.results = {}
         self.all_ks = set()
-        self.projects = Huvudbok.load_projects(self.year) or {}
+        self.merge_rules = Huvudbok.load_merge_rules(year)
+        self.merge_targets = set(self.merge_rules.values())
+        self.merged_names = set()  # targets named after a merged konto
+        self._projects = None
         self.last_written_row = 0  # need to keep track of row labels
 
-        self.process_and_output(filename, fancy)
+        if filename:
+            self.process_and_output(filename, layout)
+
+    @property
+    def projects(self):
+        """The project mapping, loaded on first use."""
+        if self._projects is None:
+            self._projects = Huvudbok.load_projects(self.year) or {}
+        return self._projects
+
+    @staticmethod
+    def load_file(filename, start=0, end=None):
+        """Stream the rows of the Fortnox output file.
+
+        Rows are yielded one at a time so that memory use stays flat
+        regardless of the size of the export.
+
+        @param start: byte offset, at a row boundary, to start reading from
+        @param end: byte offset, at a row boundary, to stop reading at. If
+            not given the file is read to the end.
+        """
+        if not start and end is None:
+            with open(filename, encoding='latin-1') as f:
+                yield from f
+            return
+
+        with open(filename, 'rb') as f:
+            f.seek(start)
+            for line in f:
+                start += len(line)
+                if end is not None and start > end:
+                    return
+                yield line.decode('latin-1')
+
+    @staticmethod
+    def split_file(filename, parts):
+        """Split the Fortnox output file into byte ranges for parallel work.
+
+        Each range but the first starts at a konto header row, so that every
+        range can be crunched without knowing about the rows before it.
+
+        @param parts: the number of ranges to aim for
+        @return: list of (start, end) byte offsets
+        """
+        size = os.path.getsize(filename)
+        bounds = [0]
+        with open(filename, 'rb') as f:
+            for part in range(1, parts):
+                offset = max(size * part // parts, bounds[-1])
+                f.seek(offset)
+                offset += len(f.readline())  # skip to the next full row
+                for line in f:
+                    if Huvudbok.is_konto_row(line):
+                        break
+                    offset += len(line)
+                if offset >= size:
+                    break
+                if offset > bounds[-1]:
+                    bounds.append(offset)
+        bounds.append(size)
+        return list(zip(bounds[:-1], bounds[1:]))
+
+    @staticmethod
+    def iter_konto_blocks(filename):
+        """Split the Fortnox output file into konto blocks.
+
+        A block runs from a konto header row up to the next one. Any rows
+        before the first konto header row form a block of their own.
+
+        @return: generator of (start offset, raw bytes) per block
+        """
+        with open(filename, 'rb') as f:
+            start = offset = 0
+            lines = []
+            for line in f:
+                if lines and Huvudbok.is_konto_row(line):
+                    yield start, b''.join(lines)
+                    start = offset
+                    lines = []
+                lines.append(line)
+                offset += len(line)
+            if lines:
+                yield start, b''.join(lines)
+
+    def konto_blocks(self, filename):
+        """Return the konto blocks behind each konto of the year.
+
+        The blocks of a konto, as given by iter_konto_blocks, are those of
+        the konto along with those of any konto merged into it. Equal
+        digests for two files thus mean equal results for the konto, as long
+        as they are crunched for the same year.
+
+        @return: dict of (digest, list of (start, length) of the blocks) per
+            konto
+        """
+        konto_col = Huvudbok.COL_NAME['konto']
+        digests = {}
+        blocks = {}
+        for start, block in Huvudbok.iter_konto_blocks(filename):
+            konto = block.split(b'\t', konto_col + 1)[konto_col].strip()
+            konto = konto.decode('latin-1')
+            if not is_int(konto):
+                continue  # the rows before the first konto header row
+            konto = self.merge_rules.get(konto, konto)
+            if konto in self.merge_targets and konto in digests:
+                digests[konto].update(block)
+                blocks[konto].append((start, len(block)))
+            else:  # just like the konto results, start over
+                digests[konto] = hashlib.blake2b(block, digest_size=20)
+                blocks[konto] = [(start, len(block))]
+        return {konto: (digest.digest(), blocks[konto])
+                for konto, digest in digests.items()}
+
+    def process_blocks(self, filename, blocks):
+        """Crunch some of the konto blocks of the Fortnox output file.
+
+        Crunching every block of a konto, as given by konto_blocks, gives
+        the same results for the konto as crunching the whole file.
+
+        @param blocks: list of (start, length) of the blocks
+        """
+        with open(filename, 'rb') as f:
+            for start, length in sorted(blocks):
+                f.seek(start)
+                self.process_rows(
+                    (line.decode('latin-1')
+                     for line in io.BytesIO(f.read(length))),
+                    start)
 
     @staticmethod
-    def load_file(filename):
-        """Load the Fortnox output file."""
-        with open(filename, encoding='latin-1') as f:
-            return f.readlines()
+    def is_konto_row(line):
+        """Check if a raw row of the Fortnox output file is a konto header."""
+        konto_col = Huvudbok.COL_NAME.get('konto')
+        konto = line.split(b'\t', konto_col + 1)[konto_col].strip()
+        return bool(konto) and is_int(konto.decode('latin-1'))
 
     @staticmethod
     def load_projects(year):
-        """Load the project json file."""
-        filename = 'projects_{}.json'.format(year)
-        try:
-            with open(filename) as f:
-                return json.load(f)
-        except FileNotFoundError:
-            print('Seems like a project mapping file is missing. '
-                  'Please create one at "{}". Until then the outputted result '
-                  'will not contain project names.'.format(filename))
+        """Return the project mapping of a year, see ProjectRegistry."""
+        return PROJECTS.get(year)
+
+    @staticmethod
+    def load_merge_rules(year):
+        """Load the konto merge rules of a year from merge_{year}.json.
+
+        The file is looked for in CONFIG_DIR, the directory of this script.
+
+        The file lists the konto to merge, each as a dict with the "konto" to
+        merge and the konto to merge it "into" (and an optional "comment").
+        A merged konto is crunched as if its rows belonged to the konto it is
+        merged into, which is then named after the merged konto.
 
-    def process_and_output(self, filename, fancy):
+        @return: dict of the konto to merge into, per merged konto
+        """
+        if year not in Huvudbok._merge_rules:
+            filename = os.path.join(
+                Huvudbok.CONFIG_DIR, 'merge_{}.json'.format(year))
+            try:
+                with open(filename) as f:
+                    rules = {
+                        str(rule['konto']): str(rule['into'])
+                        for rule in json.load(f)}
+            except FileNotFoundError:
+                rules = {}
+            chained = set(rules).intersection(rules.values())
+            if chained:
+                raise ValueError(
+                    'Konto {} in "{}" is both merged and merged into.'.format(
+                        ', '.join(sorted(chained)), filename))
+            Huvudbok._merge_rules[year] = rules
+        return Huvudbok._merge_rules[year]
+
+    def process_and_output(self, filename, layout):
         """Crunch the huvudbok and output the results."""
+        cached = self.crunch(filename)
+        self.finish(filename, layout, cached=cached)
+
+    def crunch(self, filename):
+        """Crunch the huvudbok, or load the crunched data from the cache.
+
+        @return: whether the crunched data came from the cache
+        """
+        state = None
+        with self.stage('load'):
+            if self.cache:
+                key = self.cache_key(filename)
+                state = self.cache.load(key)
+
+            if state:
+                self.set_state(state)
+
+        if not state:
+            with self.stage('parse'):
+                if self.checkpoint:
+                    self.process_file_incremental(filename, self.checkpoint)
+                elif self.jobs > 1:
+                    self.process_file_parallel(filename)
+                elif self.engine == 'numpy':
+                    self.process_file_columnar(filename)
+                else:
+                    self.process_file(filename)
+            if self.cache:
+                with self.stage('load'):
+                    self.cache.save(key, self.get_state())
+        return bool(state)
+
+    def cache_key(self, filename):
+        """Return the key of the crunched data of the file in the cache."""
+        return self.cache.key(
+            filename, Huvudbok.PARSER_VERSION, self.year, self.period,
+            sorted(self.merge_rules.items()))
+
+    def load_cached(self, filename):
+        """Load the crunched data from the cache, if it is there.
+
+        @return: whether the crunched data came from the cache
+        """
+        if not self.cache:
+            return False
+        with self.stage('load'):
+            state = self.cache.load(self.cache_key(filename))
+            if state:
+                self.set_state(state)
+        return bool(state)
+
+    def stage(self, name):
+        """Return a context manager timing a stage, if profiling."""
+        return profile_stage(self.profile, name)
+
+    @staticmethod
+    def process_years(filename, years=None, layout='basic', period=None,
+                      cache=None, profile=None, output_format='tsv',
+                      drill_down=False):
+        """Crunch several years of the Fortnox output file in a single pass.
+
+        Each year gets its own Huvudbok, with its own project mapping and
+        merge rules, and its own output file.
+
+        @param years: list of years to crunch. If not given, every year found
+            in the file is crunched.
+        @param layout: 'basic', 'fancy' or 'sparse', see output
+        @param period: 'month' or 'quarter' to also crunch each year per period
+        @param cache: LedgerCache to use if all of the years are listed
+        @param profile: Profile in which to record timings and counters
+        @param output_format: 'tsv', 'xlsx' or 'parquet', see OUTPUT_BACKENDS
+        @param drill_down: whether to also write a DrillDownIndex per year
+        @return: dict of Huvudbok per year
+        """
+        books = {
+            year: Huvudbok(None, year, layout, period=period, profile=profile,
+                           output_format=output_format, drill_down=drill_down)
+            for year in years or []}
+        if cache and years:
+            with profile_stage(profile, 'load'):
+                keys = {
+                    year: cache.key(
+                        filename, Huvudbok.PARSER_VERSION, year, period,
+                        sorted(books[year].merge_rules.items()))
+                    for year in years}
+                states = {year: cache.load(key) for year, key in keys.items()}
+            if all(states.values()):
+                for year, huvudbok in sorted(books.items()):
+                    huvudbok.set_state(states[year])
+                    huvudbok.finish(
+                        filename, layout, label=year, cached=True)
+                return books
+
+        with profile_stage(profile, 'parse'):
+            Huvudbok.process_years_file(
+                filename, books, years, period, profile)
+
+        for year, huvudbok in sorted(books.items()):
+            if cache:
+                with huvudbok.stage('load'):
+                    cache.save(
+                        cache.key(
+                            filename, Huvudbok.PARSER_VERSION, year, period,
+                            sorted(huvudbok.merge_rules.items())),
+                        huvudbok.get_state())
+            huvudbok.output_format = output_format  # also for years found
+            huvudbok.drill_down = drill_down
+            huvudbok.finish(filename, layout, label=year)
+        return books
+
+    @staticmethod
+    def process_years_file(filename, books, years, period, profile):
+        """Feed the rows of the Fortnox output file to the Huvudbok per year.
+
+        @param books: dict of Huvudbok per year, to which any new years found
+            in the file are added unless years are given
+        """
+
+        headers = {}  # every konto header seen so far, for new books
+        konto = ''
         i = 0
-        for row in Huvudbok.load_file(filename):
-            i += 1
+        for i, row in enumerate(Huvudbok.load_file(filename), 1):
             try:
-                self.process_row(row)
+                cols = row.split('\t')
+                if is_int(Huvudbok.get_col(cols, 'konto')):
+                    konto = Huvudbok.get_col(cols, 'konto')
+                    headers[konto] = Huvudbok.get_col(cols, 'namn')
+                    for huvudbok in books.values():
+                        huvudbok.start_konto(konto, headers[konto])
+
+                date = Huvudbok.get_col(cols, 'datum')
+                if not date:
+                    continue
+                year = date[:4]
+                huvudbok = books.get(year)
+                if not huvudbok:
+                    if years or not is_int(year):
+                        continue
+                    # a year first seen mid-file, catch up on the konto
+                    huvudbok = books[year] = Huvudbok(
+                        None, year, period=period, profile=profile)
+                    for seen_konto, name in headers.items():
+                        huvudbok.start_konto(seen_konto, name)
+                    huvudbok.konto = huvudbok.merge_rules.get(konto, konto)
+                huvudbok.add_row(cols)
+                huvudbok.rows_accepted += 1
             except (IndexError, KeyError, ValueError, TypeError):
                 print('row {}: {}'.format(i, row))
                 raise
+        if profile:
+            profile.count('rows seen', i)
 
-        if self.year == '2018':
-            self.tweak_2018()
+    def finish(self, filename, layout, label=None, cached=False):
+        """Output the crunched data, and the drill-down index if wanted.
 
+        @param cached: whether the crunched data came from the cache
+        """
+        with self.stage('output'):
+            self.output(filename, layout, label)
+        if self.drill_down:
+            with self.stage('index'):
+                self.write_drill_down(filename, label)
+        if self.profile:
+            self.profile.add_huvudbok(self, cached)
+
+    def get_state(self):
+        """Return the crunched data as plain types."""
+        return {
+            'results': {
+                konto: dict(values) for konto, values in self.results.items()},
+            'all_konto': self.all_konto,
+            'all_ks': sorted(self.all_ks),
+            'rows': self.rows_accepted + self.rows_cached,
+            'periods': {
+                period: huvudbok.get_state()
+                for period, huvudbok in self.period_books.items()},
+        }
+
+    def set_state(self, state):
+        """Replace the crunched data by that given by get_state."""
+        self.results = {
+            konto: defaultdict(int, values)
+            for konto, values in state['results'].items()}
+        self.all_konto = dict(state['all_konto'])
+        self.all_ks = set(state['all_ks'])
+        self.rows_cached = state['rows']
+        self.period_books = {}
+        for period, period_state in state['periods'].items():
+            huvudbok = self.period_books[period] = Huvudbok(None, self.year)
+            huvudbok.set_state(period_state)
+
+    def output(self, filename, layout, label=None):
+        """Output the results next to the Fortnox output file.
+
+        Any per period results are output to one file per period, using the
+        same columns as the output for the whole year.
+
+        @param filename: the Fortnox output file
+        @param layout: 'basic' for basic_output, 'fancy' for fancy_output or
+            'sparse' for sparse_output, written using the backend given by
+            the output format
+        @param label: added to the output file name to tell it apart
+        """
+        for period, huvudbok in sorted(self.period_books.items()):
+            huvudbok.all_ks = self.all_ks
+            huvudbok._projects = self.projects
+            huvudbok.output_format = self.output_format
+            huvudbok.output(filename, layout, label=period)
+            self.bytes_written += huvudbok.bytes_written
+
+        self.last_written_row = 0
+        basename = Huvudbok.get_basename(filename, label)
+        backend = OUTPUT_BACKENDS[self.output_format]
+        out_name = '{}_crunched{}{}'.format(
+            basename, Huvudbok.LAYOUTS[layout], backend.SUFFIX)
+        writer = getattr(self, '{}_output'.format(layout))
+        with backend(out_name) as self.out:
+            writer()
+        self.bytes_written += os.path.getsize(out_name)
+
+    @staticmethod
+    def get_basename(filename, label=None):
+        """Return the start of the output file names for a Fortnox file.
+
+        @param label: added to the output file name to tell it apart
+        """
         basename = os.path.splitext(filename)[0]
-        if not fancy:
-            out_name = '{}_crunched.tsv'.format(basename)
-            with open(out_name, 'w') as self.f_out:
-                self.basic_output()
-        else:
-            out_name = '{}_crunched_fancy.tsv'.format(basename)
-            with open(out_name, 'w') as self.f_out:
-                self.fancy_output()
+        if label:
+            basename = '{}_{}'.format(basename, label)
+        return basename
 
-    def get_col(self, cols, col_name):
+    def write_drill_down(self, filename, label=None):
+        """Write a DrillDownIndex for the year next to the output.
+
+        An existing index for the same Fortnox output file and merge rules
+        is kept as is.
+        """
+        index_name = Huvudbok.get_basename(filename, label) + (
+            DrillDownIndex.SUFFIX)
+        params = (Huvudbok.PARSER_VERSION, self.year,
+                  sorted(self.merge_rules.items()))
+        if DrillDownIndex.load(index_name, filename, params):
+            return
+        index = DrillDownIndex.build(filename, self.year, self.merge_rules)
+        index.save(index_name)
+        self.bytes_written += os.path.getsize(index_name)
+
+    def process_file(self, filename, start=0, end=None):
+        """Feed the rows of the Fortnox output file to process_row.
+
+        @param start: byte offset, at a row boundary, to start reading from
+        @param end: byte offset, at a row boundary, to stop reading at
+        """
+        self.process_rows(Huvudbok.load_file(filename, start, end), start)
+
+    def process_rows(self, rows, start=0):
+        """Feed rows of the Fortnox output file to process_row.
+
+        @param rows: iterable of rows
+        @param start: byte offset of the first row, for error reports
+        """
+        i = accepted = 0
+        for i, row in enumerate(rows, 1):
+            try:
+                if self.process_row(row):
+                    accepted += 1
+            except (IndexError, KeyError, ValueError, TypeError):
+                print('row {}: {}'.format(row_label(i, start), row))
+                raise
+        self.rows_seen += i
+        self.rows_accepted += accepted
+
+    def process_file_incremental(self, filename, checkpoint):
+        """Crunch the Fortnox output file, reusing the work of earlier runs.
+
+        The file is split into konto blocks, each identified by a hash of its
+        contents. Blocks found in the checkpoint, typically written when
+        crunching an earlier export of the same year, are not crunched again.
+        Only changed or new blocks are crunched, whereafter the checkpoint is
+        replaced by one for this file.
+
+        @param checkpoint: path to the checkpoint file, created if missing
+        """
+        params = (Huvudbok.PARSER_VERSION, self.year,
+                  sorted(self.merge_rules.items()))
+        saved = read_state(checkpoint) or {}
+        saved_blocks = saved.get('blocks', {})
+        if saved.get('params') != params:
+            saved_blocks = {}
+
+        blocks = {}
+        crunched = 0
+        for start, block in Huvudbok.iter_konto_blocks(filename):
+            digest = hashlib.blake2b(block, digest_size=20).digest()
+            partial = blocks.get(digest) or saved_blocks.get(digest)
+            if not partial:
+                huvudbok = Huvudbok(None, self.year)
+                huvudbok.process_rows(
+                    (line.decode('latin-1') for line in io.BytesIO(block)),
+                    start)
+                partial = (
+                    huvudbok.results, huvudbok.all_konto, huvudbok.all_ks,
+                    huvudbok.merged_names)
+                self.rows_seen += huvudbok.rows_seen
+                self.rows_accepted += huvudbok.rows_accepted
+                crunched += 1
+            blocks[digest] = partial
+            self.absorb(*partial)
+
+        write_state(checkpoint, {'params': params, 'blocks': blocks})
+        print('Crunched {} of {} konto blocks, the rest were unchanged.'
+              .format(crunched, len(blocks)))
+
+    def process_file_parallel(self, filename):
+        """Crunch the Fortnox output file split across several processes.
+
+        The file is split at konto header rows. Each part is crunched on its
+        own and the partial results are then merged in file order, giving
+        the same results as crunching the file in one go.
+        """
+        chunks = Huvudbok.split_file(filename, self.jobs)
+        with ProcessPoolExecutor(min(self.jobs, len(chunks))) as executor:
+            partials = executor.map(
+                _crunch_chunk, repeat(filename), repeat(self.year),
+                repeat(self.engine), chunks)
+            for results, all_konto, all_ks, merged, seen, accepted in partials:
+                self.absorb(results, all_konto, all_ks, merged)
+                self.rows_seen += seen
+                self.rows_accepted += accepted
+
+    def absorb(self, results, all_konto, all_ks, merged_names=()):
+        """Merge in the results from a later part of the file.
+
+        Just as for a repeated konto header row, a konto present in the
+        later part replaces any earlier data for that konto, except for konto
+        which others are merged into, to which the later data is added.
+
+        @param merged_names: the konto of the later part which were named
+            after a konto merged into them
+        """
+        for konto, values in results.items():
+            if konto in self.merge_targets:
+                totals = self.results.setdefault(konto, defaultdict(int))
+                for ks, amount in values.items():
+                    totals[ks] += amount
+            else:
+                self.results[konto] = defaultdict(int, values)
+        for konto, name in all_konto.items():
+            if konto in merged_names:
+                self.merged_names.add(konto)
+            elif konto in self.merged_names:
+                continue
+            self.all_konto[konto] = name
+        self.all_ks.update(all_ks)
+
+    def process_file_columnar(self, filename, start=0, end=None):
+        """Crunch the Fortnox output file using the columnar numpy engine.
+
+        The konto, ks, debet and kredit columns of all rows within the year
+        are collected into arrays, converted to numbers in one go and summed
+        per konto and ks into a dense matrix, from which the results are set.
+
+        @param start: byte offset, at a row boundary, to start reading from
+        @param end: byte offset, at a row boundary, to stop reading at
+        """
+        try:
+            import numpy
+        except ImportError:
+            raise ImportError('The numpy engine requires numpy.')
+
+        # plain column indexes, get_col is too slow for the inner loop
+        konto_col, namn_col, ks_col, datum_col, debet_col, kredit_col = (
+            Huvudbok.COL_NAME[name] for name in (
+                'konto', 'namn', 'ks', 'datum', 'debet', 'kredit'))
+
+        blocks = []  # the konto of each konto header row, in file order
+        rows = []
+        block_vals = []
+        ks_vals = []
+        debet_vals = []
+        kredit_vals = []
+        rows_in = Huvudbok.load_file(filename, start, end)
+        i = 0
+        for i, row in enumerate(rows_in, 1):
+            try:
+                cols = row.split('\t')
+                konto = cols[konto_col].strip()
+                if konto and is_int(konto):
+                    self.start_konto(konto, cols[namn_col].strip())
+                    blocks.append(self.konto)
+
+                if len(cols) <= datum_col:
+                    continue
+                date = cols[datum_col].strip()
+                if not date or not date.startswith(self.year):
+                    continue
+                if not blocks:
+                    raise KeyError(self.konto)
+                rows.append(i)
+                block_vals.append(len(blocks) - 1)
+                ks_vals.append(cols[ks_col].strip() or Huvudbok.KS_DEFAULT)
+                debet_vals.append(cols[debet_col].strip())
+                kredit_vals.append(cols[kredit_col].strip())
+            except (IndexError, KeyError, ValueError, TypeError):
+                print('row {}: {}'.format(row_label(i, start), row))
+                raise
+
+        self.rows_seen += i
+        self.rows_accepted += len(rows)
+
+        # a konto header resets the konto, so only its last block counts,
+        # unless other konto are merged into it
+        last_block = {konto: i for i, konto in enumerate(blocks)}
+        if not rows:
+            return
+
+        try:
+            amounts = to_ore_array(kredit_vals) - to_ore_array(debet_vals)
+        except ValueError:
+            # locate the broken row for the error report
+            for i, debet, kredit in zip(rows, debet_vals, kredit_vals):
+                try:
+                    to_ore(debet) - to_ore(kredit)
+                except ValueError:
+                    print('row {}: {}\t{}'.format(
+                        row_label(i, start), debet, kredit))
+                    raise
+            raise
+
+        ks_values, ks_index = numpy.unique(ks_vals, return_inverse=True)
+        num_ks = len(ks_values)
+        cells = numpy.array(block_vals, dtype=numpy.int64) * num_ks + ks_index
+        # summed as float64, which is exact for sums below 2**53 öre
+        matrix = numpy.rint(numpy.bincount(
+            cells, weights=amounts, minlength=len(blocks) * num_ks))
+
+        # add the cells in the order they first appear, just like process_row
+        used_cells, first_row = numpy.unique(cells, return_index=True)
+        ks_values = ks_values.tolist()
+        for cell in used_cells[numpy.argsort(first_row)].tolist():
+            block, ks = divmod(cell, num_ks)
+            konto = blocks[block]
+            if last_block[konto] == block or konto in self.merge_targets:
+                self.results[konto][ks_values[ks]] += int(matrix[cell])
+        self.all_ks.update(ks_values)
+
+    @staticmethod
+    def get_col(cols, col_name):
         col_num = Huvudbok.COL_NAME.get(col_name)
         if len(cols) < col_num:
             return None
         return cols[col_num].strip()
 
     def process_row(self, row):
+        """Process a row of the Fortnox output file.
+
+        @return: whether the row was added to the results
+        """
         cols = row.split('\t')
 
         # Load konto
         if is_int(self.get_col(cols, 'konto')):
-            self.konto = self.get_col(cols, 'konto')
-            self.results[self.konto] = defaultdict(float)
-
-            self.all_konto[self.konto] = self.get_col(cols, 'namn')
+            self.start_konto(
+                self.get_col(cols, 'konto'), self.get_col(cols, 'namn'))
 
         # load lines with data
         date = self.get_col(cols, 'datum')
         if not date or not date.startswith(self.year):
-            return
+            return False
+        self.add_row(cols)
+        return True
+
+    def start_konto(self, konto, name):
+        """Start collecting data for a konto, as given by a header row.
+
+        The data of a konto with a merge rule is collected into the konto it
+        is merged into, which takes its name. Konto which others are merged
+        into keep their data rather than starting over.
+        """
+        self.konto = self.merge_rules.get(konto, konto)
+        if self.konto in self.merge_targets:
+            self.results.setdefault(self.konto, defaultdict(int))
+            if self.konto != konto:
+                self.merged_names.add(self.konto)
+                self.all_konto[self.konto] = name
+            elif self.konto not in self.merged_names:
+                self.all_konto[self.konto] = name
+        else:
+            self.results[self.konto] = defaultdict(int)
+            self.all_konto[self.konto] = name
+
+        for huvudbok in self.period_books.values():
+            huvudbok.start_konto(konto, name)
+
+    def add_row(self, cols):
+        """Add the data of a row to the current konto."""
         ks = self.get_col(cols, 'ks') or Huvudbok.KS_DEFAULT
+        debet = to_ore(self.get_col(cols, 'debet'))
+        kredit = to_ore(self.get_col(cols, 'kredit'))
+        self.add_amount(ks, kredit - debet)
+
+        if self.period:
+            period = get_period(self.get_col(cols, 'datum'), self.period)
+            self.get_period_book(period).add_amount(ks, kredit - debet)
+
+    def add_amount(self, ks, amount):
+        """Add an amount to a ks of the current konto."""
         self.all_ks.add(ks)
+        self.results[self.konto][ks] += amount
 
-        debet = fix_num(self.get_col(cols, 'debet'))
-        kredit = fix_num(self.get_col(cols, 'kredit'))
-        self.results[self.konto][ks] += kredit - debet
-
-    def tweak_2018(self):
-        """2018 was a messy year so merge several konto."""
-        merge = {
-            '3890': '3010',  # medlemsavgift privat
-            '3891': '3011',  # medlemsavgift juridisk person
-            '3869': '3018',  # donationer övriga
-            '3860': '3012',  # donationer privat
-            '3861': '3013',  # donationer juridisk person
-            '4610': '4910',  # Projektkonsulter
-            '6212': '6211',  # Mobiltelefon
-            '7632': '7631',  # Personalrepresentation, ej avdragsgill
-        }
+    def get_period_book(self, period):
+        """Return the Huvudbok for a period, setting it up if needed.
 
-        for old_konto, new_konto in merge.items():
-            if new_konto not in self.results.keys():
-                self.results[new_konto] = self.results.pop(old_konto)
-            else:
-                for ks, val in self.results[old_konto].items():
-                    self.results[new_konto][ks] += val
-                del self.results[old_konto]
-            self.all_konto[new_konto] = self.all_konto.pop(old_konto)
+        A new period Huvudbok is given all konto seen so far, as if it had
+        crunched the file from the start.
+        """
+        huvudbok = self.period_books.get(period)
+        if not huvudbok:
+            huvudbok = self.period_books[period] = Huvudbok(None, self.year)
+            huvudbok.merged_names.update(self.merged_names)
+            for konto in self.results:
+                huvudbok.start_konto(konto, self.all_konto[konto])
+            huvudbok.konto = self.konto
+        return huvudbok
 
     def basic_output(self):
-        """Produce basic .tsv output containing only static data.
+        """Produce basic output containing only static data.
 
         Adds two header rows one with project ids and one with project names,
         along with a single summation line.
@@ -137,7 +858,8 @@ class Huvudbok(object):
         self.print_header_lines()
 
         # Each lines
-        ks_sums = defaultdict(float)
+        sorted_ks = sorted(self.all_ks)
+        ks_sums = defaultdict(int)
         for konto in sorted(self.results.keys()):
             line = [konto, self.all_konto.get(konto)]
 
@@ -145,22 +867,22 @@ class Huvudbok(object):
             if not any(val != 0 for val in self.results[konto].values()):
                 continue
 
-            line.append('{:.2f}'.format(sum(self.results[konto].values())))
-            for ks in sorted(self.all_ks):
+            line.append(sum(self.results[konto].values()))
+            for ks in sorted_ks:
                 val = self.results[konto].get(ks) or 0
                 ks_sums[ks] += val
-                line.append('{:.2f}'.format(val))
-            self.print_tsv_line(line)
+                line.append(val)
+            self.print_line(line)
 
         # summation lines
-        self.print_tsv_line([])
+        self.print_line([])
         line = ['', 'Total', '']
-        for ks in sorted(self.all_ks):
-            line.append('{:.2f}'.format(ks_sums.get(ks)))
-        self.print_tsv_line(line)
+        for ks in sorted_ks:
+            line.append(ks_sums[ks])
+        self.print_line(line)
 
     def fancy_output(self):
-        """Produce .tsv output with sections and spreadsheet functions.
+        """Produce output with sections and spreadsheet functions.
 
         Adds two header rows one with project ids and one with project names,
         along with a single summation line.
@@ -170,7 +892,7 @@ class Huvudbok(object):
         The output is only suitable for being used in a spreadsheet supporting
         the SUM(A1:Z9)-function.
         """
-        self.sections = Huvudbok.set_up_sections()
+        self.sections = Huvudbok.set_up_sections(self.year)
 
         # output headers
         self.print_header_lines()
@@ -178,32 +900,50 @@ class Huvudbok(object):
         # Each lines
         active_section = None
         data_cols = self.get_data_cols(3)  # column letters in use for data
+        sorted_ks = sorted(self.all_ks)
         for konto in sorted(self.results.keys()):
             # skip empty konto
             if not any(val != 0 for val in self.results[konto].values()):
                 continue
 
             # handle sections
+            konto_num = int(konto)
             if not active_section:
-                active_section = self.get_active_section(konto)
-            while active_section and int(konto) not in active_section.range:
+                active_section = self.get_active_section(konto_num)
+            while active_section and konto_num not in active_section.range:
                 active_section = self.swap_section(active_section, data_cols)
 
             if not (active_section and active_section.hide):
                 line = [konto, self.all_konto.get(konto),
                         self.current_row_sum_cell(data_cols)]  # id, name, sum
-                for ks in sorted(self.all_ks):
+                for ks in sorted_ks:
                     val = self.results[konto].get(ks) or 0
-                    line.append('{:.2f}'.format(val))
-                self.print_tsv_line(line)
+                    line.append(val)
+                self.print_line(line)
 
         # close any open section and add any missing ones
         while active_section:
             active_section = self.swap_section(active_section, data_cols)
 
-    def print_tsv_line(self, line):
-        """Write a list as a .tsv row. to the output file."""
-        self.f_out.write('\t'.join(line) + '\n')
+    def sparse_output(self):
+        """Produce output with a row per non-zero konto and ks.
+
+        Unlike basic_output and fancy_output there is a row, with the konto,
+        ks and amount, for each non-zero cell rather than a column per ks,
+        making the output of a wide but sparse huvudbok far smaller.
+        """
+        self.print_line(['konto', 'ks', 'belopp'])
+        for konto in sorted(self.results.keys()):
+            for ks, val in sorted(self.results[konto].items()):
+                if val:
+                    self.print_line([konto, ks, val])
+
+    def print_line(self, line):
+        """Write a list as a row to the output backend.
+
+        Amounts are given as integer öre, for the backend to format.
+        """
+        self.out.write_row(line)
         self.last_written_row += 1
 
     def print_header_lines(self):
@@ -213,49 +953,63 @@ class Huvudbok(object):
         """
         line = ['', '', '']
         line += sorted(self.all_ks)
-        self.print_tsv_line(line)
+        self.print_line(line)
 
         line = ['konto', 'namn', 'Total']
         line += [self.projects.get(ks, '') for ks in sorted(self.all_ks)]
-        self.print_tsv_line(line)
+        self.print_line(line)
 
     @staticmethod
-    def set_up_sections():
+    def set_up_sections(year=None):
         """Set up the section data.
 
-        This is largely hardcoded. Konto are allowed in the range before the
-        first section or after the last one, but the range across the sections
-        must be uninterrupted.
+        The sections are defined in sections_{year}.json, or by
+        DEFAULT_SECTIONS if there is no such file. Konto are allowed in the
+        range before the first section or after the last one, but the range
+        across the sections must be uninterrupted.
+
+        Each sum line is added as a post-fix to the section given by "after"
+        and sums the sections, or earlier sum lines, given by "sum".
+
+        @return: SectionIndex
         """
-        sections = (
-            Section('Balanskonton', 1000, 3000, hide=True),
-            Section('Verksamhetsintäkter', 3000, 3900),
-            # this is actually 3520-3740 which lies inside the above range
-            Section('Försäljningsintäkter (3520 + 3740)', 3900),
-            Section('Övriga intäkter', 3900, 4000),
-            Section('Kostnader underlevernatörer', 4000, 5000),
-            Section('Övriga externa kostnader', 5000, 7000),
-            Section('Personalkostnader', 7000, 7800),
-            Section('Finansiella intäkter', 7800, 8400),
-            Section('Finansiella kostnader', 8400, 8500),
-        )
-
-        # prepare post-fixes
-        section_sums = [
-            SumLine('Summa intäkter', sections[1:4]),
-            SumLine('Summa kostnader', sections[4:7])
-        ]
-        section_sums.append(
-            SumLine('Verksamhetens över-/underskott', section_sums[:])
-        )
-        section_sums.append(
-            # över/underskott + Finansiella intäkter/kostnader
-            SumLine('Resultat', [section_sums[-1]] + list(sections[-2:]))
-        )
-        sections[3].post_fixes.append(section_sums[0])
-        sections[6].post_fixes += section_sums[1:3]
-        sections[-1].post_fixes.append(section_sums[3])
-        return sections
+        definition = Huvudbok.load_section_definition(year)
+        sections = []
+        by_name = {}
+        for data in definition['sections']:
+            section = Section(data['name'], data['start'], data.get('end'),
+                              hide=data.get('hide', False))
+            sections.append(section)
+            by_name[section.name] = section
+
+        for data in definition.get('sum_lines', []):
+            try:
+                sum_line = SumLine(
+                    data['name'], [by_name[name] for name in data['sum']])
+                by_name[data['after']].post_fixes.append(sum_line)
+            except (KeyError, AttributeError):
+                raise ValueError(
+                    'Sum line "{}" refers to an unknown section.'.format(
+                        data['name']))
+            by_name[sum_line.name] = sum_line
+        return SectionIndex(sections)
+
+    @staticmethod
+    def load_section_definition(year):
+        """Load the section json file, falling back on DEFAULT_SECTIONS.
+
+        The file is looked for in CONFIG_DIR, the directory of this script.
+        """
+        if year not in Huvudbok._section_definitions:
+            filename = os.path.join(
+                Huvudbok.CONFIG_DIR, 'sections_{}.json'.format(year))
+            try:
+                with open(filename) as f:
+                    definition = json.load(f)
+            except FileNotFoundError:
+                definition = Huvudbok.DEFAULT_SECTIONS
+            Huvudbok._section_definitions[year] = definition
+        return Huvudbok._section_definitions[year]
 
     def get_data_cols(self, leading_cols):
         """Return a list of column letters to which data is outputted.
@@ -263,9 +1017,8 @@ class Huvudbok(object):
         @param leading_cols: Number of columns with non-data
         """
         num_dat_cols = len(self.all_ks)
-        col_letters = list(string.ascii_uppercase)
-        col_letters += ['A' + s for s in string.ascii_uppercase]
-        return col_letters[leading_cols:][:num_dat_cols]
+        return [column_letters(col) for col in range(
+            leading_cols, leading_cols + num_dat_cols)]
 
     def current_row_sum_cell(self, data_cols):
         """Create a string for a summation over the next row to be written.
@@ -288,40 +1041,38 @@ class Huvudbok(object):
                     '',
                     self.current_row_sum_cell(data_cols)]
             line += [current_section.col_sum_cell(col) for col in data_cols]
-            self.print_tsv_line(line)
-            self.print_tsv_line([])
+            self.print_line(line)
+            self.print_line([])
 
         for post_fix in current_section.post_fixes:
             line = [post_fix.name, '', self.current_row_sum_cell(data_cols)]
             line += [post_fix.col_sum_cell(col) for col in data_cols]
-            self.print_tsv_line(line)
+            self.print_line(line)
             post_fix.sum_row = self.last_written_row
-            self.print_tsv_line([])
+            self.print_line([])
 
     def swap_section(self, current_section, data_cols):
         """Close the current section and return the new section."""
         self.close_current_section(current_section, data_cols)
 
-        i = self.sections.index(current_section)
-        try:
-            next_section = self.sections[i + 1]
-        except IndexError:
+        next_section = self.sections.next(current_section)
+        if not next_section:
             return None
 
         # output header row
         if not next_section.hide:
-            self.print_tsv_line([next_section.name])
+            self.print_line([next_section.name])
         next_section.start_row = self.last_written_row
         return next_section
 
     def get_active_section(self, konto):
         """Return the section applicable to the current konto."""
-        for section in self.sections:
-            if int(konto) in section.range:
-                if not section.hide:
-                    self.print_tsv_line([section.name])
-                section.start_row = self.last_written_row
-                return section
+        section = self.sections.find(int(konto))
+        if section:
+            if not section.hide:
+                self.print_line([section.name])
+            section.start_row = self.last_written_row
+            return section
 
 
 class Section(object):
@@ -336,14 +1087,16 @@ class Section(object):
         self.start_row = None  # row number for first outputted section data
         self.end_row = None  # row number for last outputted section data
         self.post_fixes = []  # objects to output when the section is closed
+        self.position = None  # index in the SectionIndex
 
     def col_sum_cell(self, col):
         """Create a string for a summation over a column of the section.
 
         @param col: The column letter to sum over
+        @return: the formula, or 0 öre if the section is empty
         """
         if self.start_row == self.end_row:
-            return '0'
+            return 0
         base_string = '=SUM({col}{start_row}:{col}{end_row})'
         return base_string.format(
             col=col, start_row=self.start_row, end_row=self.end_row)
@@ -356,6 +1109,47 @@ class Section(object):
         return self.end_row + 1
 
 
+class SectionIndex(object):
+    """The sections, in order, with a fast lookup of konto to section."""
+
+    def __init__(self, sections):
+        """Initialise a SectionIndex.
+
+        @param sections: list of Section, ordered and without overlaps
+        """
+        self.sections = sections
+        self.starts = []  # start konto of each non-empty section
+        self.non_empty = []  # the non-empty sections
+        last_stop = None
+        for position, section in enumerate(sections):
+            if last_stop is not None and section.range.start < last_stop:
+                raise ValueError(
+                    'Section "{}" overlaps the section before it.'.format(
+                        section.name))
+            section.position = position
+            if section.range:  # zero width sections can not hold konto
+                self.starts.append(section.range.start)
+                self.non_empty.append(section)
+            last_stop = max(section.range.stop, last_stop or 0)
+
+    def find(self, konto):
+        """Return the section containing a konto, or None.
+
+        @param konto: the konto number
+        @type konto: int
+        """
+        i = bisect.bisect_right(self.starts, konto) - 1
+        if i >= 0 and konto in self.non_empty[i].range:
+            return self.non_empty[i]
+        return None
+
+    def next(self, section):
+        """Return the section after the given one, or None if it is last."""
+        if section.position + 1 < len(self.sections):
+            return self.sections[section.position + 1]
+        return None
+
+
 class SumLine(object):
     """A SumLine represents a line which should sum the provided sections."""
 
@@ -379,6 +1173,716 @@ class SumLine(object):
         return '=' + '+'.join(cells_to_sum)
 
 
+class OutputBackend(object):
+    """Base class for the backends to which Huvudbok outputs its rows.
+
+    Cells are strings, formulas given as strings starting with "=", or
+    integer amounts in öre. Used as a context manager, closing the output
+    file on exit.
+    """
+
+    SUFFIX = ''  # output file name suffix
+    LAYOUTS = ('basic', 'fancy', 'sparse')  # the layouts it can output
+
+    def __init__(self, filename):
+        """Initialise a backend writing to filename."""
+        self.filename = filename
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write_row(self, row):
+        """Write a list of cells as a row."""
+        raise NotImplementedError
+
+    def close(self):
+        """Write anything left and close the output file."""
+        raise NotImplementedError
+
+
+class TsvBackend(OutputBackend):
+    """Output backend writing a .tsv file.
+
+    Rows are formatted as they come, but buffered and written in bulk.
+    """
+
+    SUFFIX = '.tsv'
+    BUFFER_ROWS = 1000  # rows to buffer before writing them
+
+    def __init__(self, filename):
+        super().__init__(filename)
+        self.f_out = open(filename, 'w')
+        self.lines = []
+
+    def write_row(self, row):
+        self.lines.append('\t'.join([
+            format_ore(cell) if cell.__class__ is int else cell
+            for cell in row]))
+        if len(self.lines) >= self.BUFFER_ROWS:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows."""
+        if self.lines:
+            self.lines.append('')  # for a trailing newline
+            self.f_out.write('\n'.join(self.lines))
+            self.lines = []
+
+    def close(self):
+        self.flush()
+        self.f_out.close()
+
+
+class XlsxBackend(OutputBackend):
+    """Output backend streaming an .xlsx file, with real formulas.
+
+    Amounts are written as numbers with two decimals. xlsxwriter is used in
+    constant memory mode, whereby it writes out each row in full before the
+    next one is started.
+    """
+
+    SUFFIX = '.xlsx'
+
+    def __init__(self, filename):
+        try:
+            import xlsxwriter
+        except ImportError:
+            raise ImportError('The xlsx output requires xlsxwriter.')
+        super().__init__(filename)
+        self.workbook = xlsxwriter.Workbook(
+            filename, {'constant_memory': True})
+        self.sheet = self.workbook.add_worksheet()
+        self.amount_format = self.workbook.add_format({'num_format': '0.00'})
+        self.next_row = 0
+
+    def write_row(self, row):
+        for col, cell in enumerate(row):
+            if cell.__class__ is int:
+                self.sheet.write_number(
+                    self.next_row, col, cell / 100, self.amount_format)
+            elif cell.startswith('='):
+                self.sheet.write_formula(
+                    self.next_row, col, cell, self.amount_format)
+            elif cell:
+                self.sheet.write_string(self.next_row, col, cell)
+        self.next_row += 1
+
+    def close(self):
+        self.workbook.close()
+
+
+class ParquetBackend(OutputBackend):
+    """Output backend writing a Parquet file, for downstream analysis.
+
+    Only the sparse layout is supported, its first row giving the column
+    names. Amounts are stored as decimals with two decimals. Rows are
+    buffered and each full buffer is written as a row group.
+    """
+
+    SUFFIX = '.parquet'
+    LAYOUTS = ('sparse',)
+    BUFFER_ROWS = 100000  # rows per row group
+
+    def __init__(self, filename):
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError('The parquet output requires pyarrow.')
+        self.pyarrow = pyarrow  # imported here, not at module load
+        super().__init__(filename)
+        self.columns = None
+        self.rows = []
+        self.writer = None
+
+    def write_row(self, row):
+        if self.columns is None:
+            self.columns = row
+            return
+        self.rows.append(row)
+        if len(self.rows) >= self.BUFFER_ROWS:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows as a row group."""
+        pyarrow = self.pyarrow
+        if not self.rows:
+            return
+        arrays = []
+        for values in zip(*self.rows):
+            if values[0].__class__ is int:
+                arrays.append(pyarrow.array(
+                    [decimal.Decimal(value).scaleb(-2) for value in values],
+                    pyarrow.decimal128(18, 2)))
+            else:
+                arrays.append(pyarrow.array(values, pyarrow.string()))
+        table = pyarrow.Table.from_arrays(arrays, names=self.columns)
+        if self.writer is None:
+            self.writer = pyarrow.parquet.ParquetWriter(
+                self.filename, table.schema)
+        self.writer.write_table(table)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        pyarrow = self.pyarrow
+        if self.writer is None:  # no rows, write the columns only
+            self.writer = pyarrow.parquet.ParquetWriter(
+                self.filename, pyarrow.schema(
+                    [(name, pyarrow.string()) for name in self.columns or []]))
+        self.writer.close()
+
+
+OUTPUT_BACKENDS = {  # output format: backend class
+    'tsv': TsvBackend,
+    'xlsx': XlsxBackend,
+    'parquet': ParquetBackend,
+}
+
+
+class DrillDownIndex(object):
+    """The rows of a Fortnox output file behind each konto and ks cell.
+
+    For every cell the byte offset and length of each row summed into it is
+    kept, whereby the rows can be read straight from the file. The index is
+    stored next to the crunched output, with the offsets delta encoded and
+    compressed, along with the size and modification time of the file so
+    that it is not used once the file has changed.
+    """
+
+    SUFFIX = '_crunched.idx'
+
+    def __init__(self, cells, export, params):
+        """Initialise a DrillDownIndex.
+
+        @param cells: dict of (offsets, lengths) arrays per ks per konto
+        @param export: (size, mtime_ns) of the Fortnox output file
+        @param params: parameters with which the file was crunched
+        """
+        self.cells = cells
+        self.export = export
+        self.params = params
+
+    @staticmethod
+    def export_stat(filename):
+        """Return the size and modification time of a Fortnox output file."""
+        stat = os.stat(filename)
+        return (stat.st_size, stat.st_mtime_ns)
+
+    @staticmethod
+    def build(filename, year, merge_rules=None):
+        """Index the rows of a year in a Fortnox output file.
+
+        Konto headers and merge rules are followed just as when crunching
+        the file, so that the rows of a cell add up to its amount.
+        """
+        merge_rules = merge_rules or {}
+        merge_targets = set(merge_rules.values())
+        konto_col, ks_col, datum_col = (
+            Huvudbok.COL_NAME[name] for name in ('konto', 'ks', 'datum'))
+        cells = {}
+        konto_cells = None
+        offset = 0
+        with open(filename, 'rb') as f:
+            for line in f:
+                cols = line.decode('latin-1').split('\t')
+                konto = cols[konto_col].strip()
+                if konto and is_int(konto):
+                    konto = merge_rules.get(konto, konto)
+                    if konto in merge_targets:
+                        konto_cells = cells.setdefault(konto, {})
+                    else:
+                        konto_cells = cells[konto] = {}
+                if (konto_cells is not None and len(cols) > datum_col
+                        and cols[datum_col].strip().startswith(year)):
+                    ks = cols[ks_col].strip() or Huvudbok.KS_DEFAULT
+                    if ks not in konto_cells:
+                        konto_cells[ks] = (array.array('Q'), array.array('I'))
+                    offsets, lengths = konto_cells[ks]
+                    offsets.append(offset)
+                    lengths.append(len(line))
+                offset += len(line)
+        params = (Huvudbok.PARSER_VERSION, year, sorted(merge_rules.items()))
+        return DrillDownIndex(cells, DrillDownIndex.export_stat(filename),
+                              params)
+
+    def save(self, filename):
+        """Store the index, delta encoding the offsets."""
+        cells = {}
+        for konto, ks_cells in self.cells.items():
+            cells[konto] = {}
+            for ks, (offsets, lengths) in ks_cells.items():
+                deltas = array.array('Q', offsets)
+                for i in range(len(deltas) - 1, 0, -1):
+                    deltas[i] -= deltas[i - 1]
+                cells[konto][ks] = (deltas, lengths)
+        write_state(filename, {
+            'export': self.export, 'params': self.params, 'cells': cells})
+
+    @staticmethod
+    def load(filename, export_file, params=None):
+        """Load an index, return None if missing or out of date.
+
+        @param export_file: the Fortnox output file the index should be for
+        @param params: parameters with which the file should be crunched, or
+            None to accept any
+        """
+        state = read_state(filename)
+        if (not state
+                or state['export'] != DrillDownIndex.export_stat(export_file)
+                or params is not None and state['params'] != params):
+            return None
+        cells = state['cells']
+        for ks_cells in cells.values():
+            for deltas, _lengths in ks_cells.values():
+                for i in range(1, len(deltas)):
+                    deltas[i] += deltas[i - 1]
+        return DrillDownIndex(cells, state['export'], state['params'])
+
+    def read_rows(self, filename, konto, ks):
+        """Read the rows behind a cell from the Fortnox output file.
+
+        @return: list of (byte offset, row) tuples
+        """
+        offsets, lengths = self.cells.get(konto, {}).get(ks, ((), ()))
+        rows = []
+        with open(filename, 'rb') as f:
+            for offset, length in zip(offsets, lengths):
+                f.seek(offset)
+                rows.append(
+                    (offset, f.read(length).decode('latin-1').rstrip('\r\n')))
+        return rows
+
+
+class ProjectRegistry(object):
+    """The project mappings of all years, shared by every Huvudbok.
+
+    Each projects_{year}.json file in the directory is loaded when first
+    needed and loaded again once it changes, so a long running process picks
+    up edited and new mappings. Besides the mapping per year, the registry
+    has an index of the names each ks has had over the years.
+    """
+
+    def __init__(self, directory=None):
+        """Initialise a ProjectRegistry.
+
+        @param directory: where to look for the projects_{year}.json files,
+            defaults to the directory of this script
+        """
+        self.directory = directory or Huvudbok.CONFIG_DIR
+        self._projects = {}  # year: (mtime_ns, loaded project mapping)
+        self._reported = set()  # years reported as missing
+        self._history = None  # ks: list of (year, name) per rename
+        self._history_files = None  # (year, mtime_ns) of the history
+
+    def filename(self, year):
+        """Return the path of the project file of a year."""
+        return os.path.join(self.directory, 'projects_{}.json'.format(year))
+
+    def years(self):
+        """Return the years with a project mapping, in order."""
+        pattern = os.path.join(self.directory, 'projects_*.json')
+        return sorted(os.path.basename(filename)[len('projects_'):-5]
+                      for filename in glob.glob(pattern))
+
+    def get(self, year):
+        """Return the project mapping of a year, or None if missing.
+
+        A missing mapping is reported, once per year.
+        """
+        filename = self.filename(year)
+        try:
+            mtime = os.stat(filename).st_mtime_ns
+        except FileNotFoundError:
+            self._projects.pop(year, None)
+            if year not in self._reported:
+                self._reported.add(year)
+                print('Seems like a project mapping file is missing. '
+                      'Please create one at "{}". Until then the outputted '
+                      'result will not contain project names.'.format(
+                          filename))
+            return None
+        if year not in self._projects or self._projects[year][0] != mtime:
+            with open(filename) as f:
+                self._projects[year] = (mtime, json.load(f))
+            self._reported.discard(year)
+        return self._projects[year][1]
+
+    def history(self, ks):
+        """Return the names of a ks over the years.
+
+        @return: list of (year, name) for the first year of each name
+        """
+        files = []
+        for year in self.years():
+            with contextlib.suppress(FileNotFoundError):
+                files.append((year, os.stat(self.filename(year)).st_mtime_ns))
+        if files != self._history_files:
+            self._history = {}
+            for year, _mtime in files:
+                for project, name in (self.get(year) or {}).items():
+                    names = self._history.setdefault(project, [])
+                    if not names or names[-1][1] != name:
+                        names.append((year, name))
+            self._history_files = files
+        return self._history.get(ks, [])
+
+
+PROJECTS = ProjectRegistry()  # shared by every Huvudbok
+
+
+class LedgerCache(object):
+    """An on-disk cache of crunched huvudbok data.
+
+    Entries are keyed by a hash of the contents of the Fortnox output file
+    along with any parameters affecting the crunching. The least recently
+    used entries are removed once the cache grows beyond its maximum size.
+    """
+
+    DEFAULT_MAX_SIZE = 100 * 1024 * 1024  # bytes
+    SUFFIX = '.cache'
+
+    def __init__(self, directory=None, max_size=DEFAULT_MAX_SIZE):
+        """Initialise a LedgerCache.
+
+        @param directory: where to store the cache, defaults to huvudbok in
+            the user cache directory.
+        @param max_size: the maximum total size of the cache in bytes
+        """
+        self.directory = directory or os.path.join(
+            os.environ.get('XDG_CACHE_HOME')
+            or os.path.join(os.path.expanduser('~'), '.cache'),
+            'huvudbok')
+        self.max_size = max_size
+        self._digests = {}  # (path, size, mtime): content digest
+
+    def file_digest(self, filename):
+        """Return a hash of the contents of a file.
+
+        The hash is remembered for as long as the size and modification time
+        of the file are unchanged.
+        """
+        stat = os.stat(filename)
+        stat_key = (os.path.abspath(filename), stat.st_size, stat.st_mtime_ns)
+        if stat_key not in self._digests:
+            digest = hashlib.blake2b()
+            with open(filename, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(block)
+            self._digests[stat_key] = '{}-{}'.format(
+                digest.hexdigest(), stat.st_size)
+        return self._digests[stat_key]
+
+    def key(self, filename, *params):
+        """Return the cache key for a file crunched with the given params."""
+        key = hashlib.blake2b(
+            self.file_digest(filename).encode(), digest_size=20)
+        key.update(repr(params).encode())
+        return key.hexdigest()
+
+    def path(self, key):
+        """Return the path of the cache file for a key."""
+        return os.path.join(self.directory, key + LedgerCache.SUFFIX)
+
+    def load(self, key):
+        """Return the cached data for a key, or None if not cached."""
+        state = read_state(self.path(key))
+        if state is not None:
+            try:
+                os.utime(self.path(key))  # mark as recently used
+            except FileNotFoundError:
+                pass  # pruned by another process since read
+        return state
+
+    def save(self, key, state):
+        """Store the data for a key and prune the cache."""
+        os.makedirs(self.directory, exist_ok=True)
+        write_state(self.path(key), state)
+        self.prune()
+
+    def entries(self):
+        """Return (mtime, size, path) of all cache files, oldest first."""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        entries = []
+        for name in names:
+            if name.endswith(LedgerCache.SUFFIX):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    continue  # removed by another process since listed
+                entries.append((
+                    stat.st_mtime, stat.st_size,
+                    os.path.join(self.directory, name)))
+        return sorted(entries)
+
+    def prune(self):
+        """Remove the least recently used entries beyond the maximum size."""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)  # unless another process already did
+            total -= size
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        for _, _, path in self.entries():
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+
+class Profile(object):
+    """Wall time per stage and counters for a run of huvudbok.py."""
+
+    def __init__(self):
+        """Initialise a Profile."""
+        self.timings = {}  # stage: seconds
+        self.counters = defaultdict(int)
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Time a stage, adding to the time of any earlier run of it."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = (
+                self.timings.get(name, 0) + time.perf_counter() - start)
+
+    def count(self, name, value):
+        """Add to a counter."""
+        self.counters[name] += value
+
+    def add_huvudbok(self, huvudbok, cached=False):
+        """Add the counters of a finished Huvudbok."""
+        if huvudbok.rows_seen:
+            self.count('rows seen', huvudbok.rows_seen)
+        self.count('rows accepted', huvudbok.rows_accepted)
+        self.counters['rows skipped'] = (
+            self.counters['rows seen'] - self.counters['rows accepted'])
+        self.count('konto', len(huvudbok.results))
+        self.count('ks', len(huvudbok.all_ks))
+        self.count('bytes written', huvudbok.bytes_written)
+        self.count('cache hits', int(cached))
+
+    def as_dict(self):
+        """Return the timings and counters as a json serialisable dict."""
+        return {'timings': self.timings, 'counters': dict(self.counters)}
+
+    def summary(self):
+        """Return a human readable summary."""
+        lines = ['{:<15}{:>10.3f} s'.format(name, seconds)
+                 for name, seconds in self.timings.items()]
+        lines.append('{:<15}{:>10.3f} s'.format(
+            'total', sum(self.timings.values())))
+        lines += ['{:<15}{:>10}'.format(name, value)
+                  for name, value in self.counters.items()]
+        return '\n'.join(lines)
+
+
+def profile_stage(profile, name):
+    """Return a context manager timing a stage, if given a Profile."""
+    if profile:
+        return profile.stage(name)
+    return contextlib.nullcontext()
+
+
+def read_state(filename):
+    """Read data stored by write_state, return None if missing or broken."""
+    try:
+        with open(filename, 'rb') as f:
+            return pickle.loads(zlib.decompress(f.read()))
+    except (OSError, EOFError, zlib.error, pickle.UnpicklingError):
+        return None
+
+
+def write_state(filename, state):
+    """Store data in a compact binary file, replacing it atomically."""
+    tmp_name = '{}.{}.tmp'.format(filename, os.getpid())
+    with open(tmp_name, 'wb') as f:
+        f.write(zlib.compress(pickle.dumps(state, pickle.HIGHEST_PROTOCOL)))
+    os.replace(tmp_name, filename)
+
+
+def _crunch_chunk(filename, year, engine, chunk):
+    """Crunch a byte range of a Fortnox output file in a worker process.
+
+    @param chunk: (start, end) byte offsets as given by Huvudbok.split_file
+    @return: the results, all_konto, all_ks, merged_names, rows_seen and
+        rows_accepted of the range
+    """
+    huvudbok = Huvudbok(None, year, engine=engine)
+    if engine == 'numpy':
+        huvudbok.process_file_columnar(filename, *chunk)
+    else:
+        huvudbok.process_file(filename, *chunk)
+    return (huvudbok.results, huvudbok.all_konto, huvudbok.all_ks,
+            huvudbok.merged_names, huvudbok.rows_seen,
+            huvudbok.rows_accepted)
+
+
+def show_cell(filename, konto, ks, label=None):
+    """Print the rows of a Fortnox output file behind a konto and ks.
+
+    @param label: the label of the crunched output, see Huvudbok.output
+    @return: False if there is no up to date DrillDownIndex for the file
+    """
+    index = DrillDownIndex.load(
+        Huvudbok.get_basename(filename, label) + DrillDownIndex.SUFFIX,
+        filename)
+    if not index:
+        return False
+    debet_col = Huvudbok.COL_NAME['debet']
+    kredit_col = Huvudbok.COL_NAME['kredit']
+    total = 0
+    for offset, row in index.read_rows(filename, konto, ks):
+        print('byte {}: {}'.format(offset, row))
+        cols = row.split('\t')
+        total += to_ore(cols[kredit_col].strip()) - to_ore(
+            cols[debet_col].strip())
+    print('Total: {}'.format(format_ore(total)))
+    return True
+
+
+def compare_exports(filename, year, other_file, other_year=None,
+                    cache=None, profile=None):
+    """Compare the crunched data of two Fortnox output files, or years.
+
+    Data in the cache is used as is. Otherwise, when comparing the same
+    year, the konto blocks of the files are hashed first and only the konto
+    whose konto blocks differ are crunched.
+
+    @param filename: the Fortnox output file to compare
+    @param year: the year of filename to compare
+    @param other_file: the Fortnox output file to compare against, which may
+        be filename if comparing two years
+    @param other_year: the year of other_file, if not the same as year
+    @return: dict as given by compare_books
+    """
+    other_year = other_year or year
+    old = Huvudbok(None, other_year, cache=cache, profile=profile)
+    new = Huvudbok(None, year, cache=cache, profile=profile)
+    old_cached = old.load_cached(other_file)
+    new_cached = new.load_cached(filename)
+    if year != other_year or (old_cached and new_cached):
+        if not old_cached:
+            old.crunch(other_file)
+        if not new_cached:
+            new.crunch(filename)
+        return compare_books(old, new)
+
+    with profile_stage(profile, 'digest'):
+        old_blocks = old.konto_blocks(other_file)
+        new_blocks = new.konto_blocks(filename)
+    unchanged = {
+        konto for konto, (digest, _blocks) in new_blocks.items()
+        if konto in old_blocks and old_blocks[konto][0] == digest}
+    with profile_stage(profile, 'parse'):
+        if not old_cached:
+            old.process_blocks(other_file, [
+                block for konto, (_digest, blocks) in old_blocks.items()
+                if konto not in unchanged for block in blocks])
+        if not new_cached:
+            new.process_blocks(filename, [
+                block for konto, (_digest, blocks) in new_blocks.items()
+                if konto not in unchanged for block in blocks])
+        unchanged_ks = set()
+        if old.all_ks ^ new.all_ks:  # unless used by an unchanged konto
+            same = Huvudbok(None, year)
+            same.process_blocks(filename, [
+                block for konto in unchanged
+                for block in new_blocks[konto][1]])
+            unchanged_ks = same.all_ks
+    return compare_books(old, new, unchanged, unchanged_ks)
+
+
+def compare_books(old, new, unchanged=(), unchanged_ks=()):
+    """Compare the crunched data of two Huvudbok.
+
+    A cell missing in one of them counts as zero.
+
+    @param unchanged: konto known to have the same results in both, which
+        need not have been crunched
+    @param unchanged_ks: the ks of the unchanged konto
+    @return: dict with the sorted lists of "added_konto", "removed_konto",
+        "added_ks" and "removed_ks", the list of (konto, ks, old amount, new
+        amount) for every "changed" cell and the number of "unchanged" konto
+    """
+    unchanged = set(unchanged)
+    unchanged_ks = set(unchanged_ks)
+    changed = []
+    same = len(unchanged)
+    for konto in sorted((set(old.results) | set(new.results)) - unchanged):
+        old_values = old.results.get(konto, {})
+        new_values = new.results.get(konto, {})
+        cells = []
+        for ks in sorted(set(old_values) | set(new_values)):
+            old_value = old_values.get(ks, 0)
+            new_value = new_values.get(ks, 0)
+            if old_value != new_value:
+                cells.append((konto, ks, old_value, new_value))
+        if cells:
+            changed += cells
+        elif konto in old.results and konto in new.results:
+            same += 1
+    return {
+        'added_konto': sorted(set(new.results) - set(old.results) - unchanged),
+        'removed_konto': sorted(
+            set(old.results) - set(new.results) - unchanged),
+        'added_ks': sorted(new.all_ks - old.all_ks - unchanged_ks),
+        'removed_ks': sorted(old.all_ks - new.all_ks - unchanged_ks),
+        'changed': changed,
+        'unchanged': same,
+    }
+
+
+def print_comparison(comparison):
+    """Print a comparison given by compare_books as .tsv."""
+    for key, label in (('added_konto', 'Nya konto'),
+                       ('removed_konto', 'Borttagna konto'),
+                       ('added_ks', 'Nya ks'),
+                       ('removed_ks', 'Borttagna ks')):
+        if comparison[key]:
+            print('\t'.join([label] + comparison[key]))
+    print('\t'.join(['konto', 'ks', 'före', 'efter', 'skillnad']))
+    for konto, ks, old_value, new_value in comparison['changed']:
+        print('\t'.join([
+            konto, ks, format_ore(old_value), format_ore(new_value),
+            format_ore(new_value - old_value)]))
+    print('{} changed cells, {} konto unchanged.'.format(
+        len(comparison['changed']), comparison['unchanged']))
+
+
+def row_label(i, start=0):
+    """Describe the position of a row for error reports.
+
+    @param i: row number, counted from the start offset
+    @param start: byte offset from which rows were counted
+    """
+    if not start:
+        return str(i)
+    return '{} after byte {}'.format(i, start)
+
+
+def get_period(date, period):
+    """Return the period label of a date.
+
+    @param date: date as YYYY-MM-DD
+    @param period: 'month' or 'quarter'
+    @return: label such as 2018-03 for a month or 2018-Q1 for a quarter
+    """
+    if period == 'month':
+        return date[:7]
+    return '{}-Q{}'.format(date[:4], (int(date[5:7]) + 2) // 3)
+
+
 def fix_num(cell_value):
     """Convert Swedish style numbering to standard format."""
     if not cell_value.strip():
@@ -387,6 +1891,68 @@ def fix_num(cell_value):
     return float(value)
 
 
+def to_ore(cell_value):
+    """Convert a Swedish style amount to an integer number of öre.
+
+    Amounts with two decimals, as in Fortnox exports, are converted by
+    dropping the spaces and the decimal comma. Anything else goes via
+    Decimal, rounding to the nearest öre.
+
+    This is for exact sums rather than speed: int() of the digits costs
+    about twice float(), so per cell to_ore is no faster than fix_num.
+    """
+    if not cell_value:
+        return 0
+    if cell_value[-3:-2] == ',':
+        try:
+            return int(cell_value.replace(' ', '').replace(',', '', 1))
+        except ValueError:
+            pass  # e.g. several commas, leave it to Decimal to complain
+    value = cell_value.replace(' ', '').replace(',', '.')
+    try:
+        return int((decimal.Decimal(value) * 100).to_integral_value())
+    except decimal.InvalidOperation:
+        raise ValueError('Not an amount: {}'.format(cell_value))
+
+
+def to_ore_array(cell_values):
+    """Convert a sequence of Swedish style amounts to a numpy öre array.
+
+    Vectorised version of to_ore, requires numpy.
+    """
+    import numpy
+    values = numpy.array(cell_values, dtype=str)
+    lengths = numpy.char.str_len(values)
+    commas = numpy.char.find(values, ',')
+    two_decimals = (commas >= 0) & (commas == lengths - 3)
+    if not numpy.all(two_decimals | (lengths == 0)):
+        return numpy.array([to_ore(value) for value in cell_values],
+                           dtype=numpy.int64)
+    values = numpy.char.replace(numpy.char.replace(values, ' ', ''), ',', '')
+    values[values == ''] = '0'
+    return values.astype(numpy.int64)
+
+
+def format_ore(value):
+    """Format an integer number of öre as kronor with two decimals."""
+    if value < 0:
+        return '-%d.%02d' % divmod(-value, 100)
+    return '%d.%02d' % divmod(value, 100)
+
+
+def column_letters(col):
+    """Return the spreadsheet letters of a column, A, B, ..., Z, AA, AB, ...
+
+    @param col: index of the column, counted from 0
+    """
+    letters = ''
+    col += 1
+    while col:
+        col, remainder = divmod(col - 1, 26)
+        letters = string.ascii_uppercase[remainder] + letters
+    return letters
+
+
 def is_int(value):
     """Check if the given value is an integer.
 
@@ -402,26 +1968,229 @@ def is_int(value):
         return False
 
 
+def is_available(module):
+    """Check if an optional module can be imported, without importing it.
+
+    @param module: the name of a top level module
+    @rtype: bool
+    """
+    return importlib.util.find_spec(module) is not None
+
+
 if __name__ == '__main__':
-    parser = argparse.ArgumentParser(description='Process Fortnox huvudbok.')
+    parser = argparse.ArgumentParser(
+        description='Process Fortnox huvudbok.',
+        usage='%(prog)s [-h] data_file [options]')
     parser.add_argument(
         '--fancy',
         '-f',
-        help='Output the data in a spreadsheet compatible .tsv file.',
-        action='store_true'
+        help=(
+            'Output the data in a spreadsheet compatible .tsv file, '
+            'same as --layout fancy.'),
+        action='store_const',
+        dest='layout',
+        const='fancy',
+        default='basic'
+    )
+    parser.add_argument(
+        '--layout',
+        '-l',
+        help=(
+            'Output layout: a konto per row and a column per ks ("basic"), '
+            'the same with sections and spreadsheet formulas ("fancy") or '
+            'a row per non-zero konto and ks ("sparse").'),
+        choices=sorted(Huvudbok.LAYOUTS),
+        default='basic'
+    )
+    parser.add_argument(
+        '--output-format',
+        '-o',
+        help=(
+            'Output file format. "xlsx" requires xlsxwriter and "parquet", '
+            'which requires pyarrow, only supports the sparse layout. '
+            'Defaults to "tsv".'),
+        choices=sorted(OUTPUT_BACKENDS),
+        default='tsv'
     )
     parser.add_argument(
         '--year',
         '-y',
         help=(
-            'Year, for use in determining project mappings and tweaks. '
+            'Year, for use in determining project mappings and merge rules. '
             'If not given, the current year will be used.'),
         default=str(datetime.date.today().year)
     )
+    parser.add_argument(
+        '--engine',
+        '-e',
+        help=(
+            'Aggregation engine. "numpy" is faster on large exports but '
+            'requires numpy.'),
+        choices=Huvudbok.ENGINES,
+        default='dict'
+    )
+    parser.add_argument(
+        '--jobs',
+        '-j',
+        help=(
+            'Number of processes to split the crunching between. '
+            'Defaults to 1.'),
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        '--years',
+        help=(
+            'Crunch each of these years, in a single pass over the file, '
+            'into a separate output file. Overrides --year.'),
+        nargs='+'
+    )
+    parser.add_argument(
+        '--all-years',
+        help='Same as --years, listing every year found in the file.',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--period',
+        '-p',
+        help=(
+            'Also crunch the data per month or quarter, outputting one file '
+            'per period alongside the one for the whole year.'),
+        choices=Huvudbok.PERIODS
+    )
+    parser.add_argument(
+        '--no-cache',
+        help='Always crunch the file, ignoring and not updating the cache.',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--clear-cache',
+        help='Empty the cache of crunched data before running.',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--cache-dir',
+        help='Where to keep the cache. Defaults to ~/.cache/huvudbok.'
+    )
+    parser.add_argument(
+        '--cache-size',
+        help='Maximum size of the cache in MB. Defaults to 100.',
+        type=int,
+        default=LedgerCache.DEFAULT_MAX_SIZE // (1024 * 1024)
+    )
+    parser.add_argument(
+        '--incremental',
+        '-i',
+        metavar='CHECKPOINT',
+        help=(
+            'Checkpoint file from crunching an earlier export of the same '
+            'year. Only konto which changed since then are crunched, and '
+            'the checkpoint is then updated. Created if missing.')
+    )
+    parser.add_argument(
+        '--profile',
+        help='Print the time spent per stage along with some counters.',
+        action='store_true'
+    )
+    parser.add_argument(
+        '--profile-json',
+        metavar='FILE',
+        help='Write the time spent per stage and the counters to a json file.'
+    )
+    parser.add_argument(
+        '--compare',
+        metavar='OTHER_FILE',
+        help=(
+            'Print the cells which differ from those of another export, '
+            'rather than outputting the crunched data. Use the data file '
+            'itself along with --compare-year to compare two years.')
+    )
+    parser.add_argument(
+        '--compare-year',
+        metavar='YEAR',
+        help='Year of the --compare file, if not the same as --year.'
+    )
+    parser.add_argument(
+        '--drill-down',
+        '-d',
+        help=(
+            'Also write an index of the rows behind each konto and ks, for '
+            'use with --show.'),
+        action='store_true'
+    )
+    parser.add_argument(
+        '--show',
+        nargs=2,
+        metavar=('KONTO', 'KS'),
+        help=(
+            'Show the rows behind a konto and ks, using the index written by '
+            'an earlier run with --drill-down, rather than crunching the '
+            'file. Give the year with --years if that run used --years.')
+    )
     parser.add_argument(
         'data_file',
         help='Path to Fortnox huvudbok .txt output file.',
-        nargs=1,
+        nargs='?',
     )
     args = parser.parse_args()
-    Huvudbok(args.data_file[0], args.year, args.fancy)
+    if not args.data_file and args.years and not is_int(args.years[-1]):
+        # --years took the data file as well, as in --years 2018 data_file
+        args.data_file = args.years.pop()
+        if not args.years:
+            parser.error('--years requires at least one year')
+    if not args.data_file:
+        parser.error('the following arguments are required: data_file')
+    if args.all_years:
+        if args.years:
+            parser.error('--all-years can not be combined with --years')
+        args.years = []
+    if (args.engine != 'dict' or args.jobs > 1) and (
+            args.years is not None or args.period or args.incremental):
+        parser.error(
+            '--years, --period and --incremental can not be combined with '
+            '--engine or --jobs')
+    if args.layout not in OUTPUT_BACKENDS[args.output_format].LAYOUTS:
+        parser.error('--output-format {} does not support --layout {}'.format(
+            args.output_format, args.layout))
+    if args.compare_year and not args.compare:
+        parser.error('--compare-year requires --compare')
+    if args.compare and (args.years is not None or args.period):
+        parser.error('--compare can not be combined with --years or --period')
+    if args.incremental and (args.years is not None or args.period):
+        parser.error(
+            '--incremental can not be combined with --years or --period')
+    if args.show:
+        label = args.years[0] if args.years else None
+        if args.years and len(args.years) > 1:
+            parser.error('--show takes a single year')
+        if not show_cell(args.data_file, *args.show, label=label):
+            parser.error(
+                'No up to date drill-down index for {}, crunch it with '
+                '--drill-down first.'.format(args.data_file))
+        parser.exit()
+    cache = LedgerCache(args.cache_dir, args.cache_size * 1024 * 1024)
+    if args.clear_cache:
+        cache.clear()
+    if args.no_cache:
+        cache = None
+    profile = None
+    if args.profile or args.profile_json:
+        profile = Profile()
+    if args.compare:
+        print_comparison(compare_exports(
+            args.data_file, args.year, args.compare, args.compare_year,
+            cache, profile))
+    elif args.years is not None:
+        Huvudbok.process_years(
+            args.data_file, args.years, args.layout, args.period, cache,
+            profile, args.output_format, args.drill_down)
+    else:
+        Huvudbok(
+            args.data_file, args.year, args.layout, args.engine, args.jobs,
+            args.period, cache, args.incremental, profile, args.output_format,
+            args.drill_down)
+    if args.profile:
+        print(profile.summary())
+    if args.profile_json:
+        with open(args.profile_json, 'w') as f:
+            json.dump(profile.as_dict(), f, indent=4)
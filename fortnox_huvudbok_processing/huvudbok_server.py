@@ -0,0 +1,198 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+"""Answer queries on crunched huvudbok exports over a local HTTP/JSON API.
+
+The exports are crunched once, per year, and kept in memory. An export is
+crunched again once the file changes, and a project mapping is loaded again
+once its projects_{year}.json changes.
+
+python huvudbok_server.py [--port 8000] path_to_huvudbok.txt [...]
+
+Queries:
+* GET /query?konto=5410&ks=123456&section=Personalkostnader&year=2019
+  returns the non-zero cells matching all of the given filters, any of
+  which may be left out, along with their total. "file" limits the query to
+  one of the exports.
+* GET /projects?ks=123456 returns the names the project has had over the
+  years.
+* GET /status returns the loaded exports and their years.
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from huvudbok import PROJECTS, Huvudbok, format_ore
+
+
+class Ledger(object):
+    """The crunched data of one or more Fortnox output files."""
+
+    def __init__(self, filenames, years=None):
+        """Initialise a Ledger, crunching the files.
+
+        @param filenames: the Fortnox output files
+        @param years: list of years to crunch, if not given every year found
+            in the files is crunched
+        """
+        self.filenames = filenames
+        self.years = years
+        self.books = {}  # filename: Huvudbok per year
+        self.stats = {}  # filename: (size, mtime_ns) when crunched
+        self.loaded = {}  # filename: time when crunched
+        self.lock = threading.Lock()
+        self.refresh()
+
+    def refresh(self):
+        """Crunch any of the files which changed since last crunched."""
+        with self.lock:
+            for filename in self.filenames:
+                stat = os.stat(filename)
+                if self.stats.get(filename) != (
+                        stat.st_size, stat.st_mtime_ns):
+                    self.load(filename)
+                    self.stats[filename] = (stat.st_size, stat.st_mtime_ns)
+
+    def load(self, filename):
+        """Crunch a file, replacing any earlier data for it."""
+        books = {year: Huvudbok(None, year) for year in self.years or []}
+        Huvudbok.process_years_file(filename, books, self.years, None, None)
+        for huvudbok in books.values():
+            PROJECTS.get(huvudbok.year)  # report a missing mapping up front
+            huvudbok.sections = Huvudbok.set_up_sections(huvudbok.year)
+        self.books[filename] = books
+        self.loaded[filename] = time.time()
+
+    def query(self, konto=None, ks=None, section=None, year=None,
+              filename=None):
+        """Return the non-zero cells matching all of the given filters.
+
+        @return: dict with a list of "cells" and their "total"
+        """
+        cells = []
+        total = 0
+        for book_file, books in sorted(self.books.items()):
+            if filename and filename != book_file:
+                continue
+            for book_year, huvudbok in sorted(books.items()):
+                if year and year != book_year:
+                    continue
+                projects = PROJECTS.get(book_year) or {}
+                if konto:
+                    konto_list = [konto] if konto in huvudbok.results else []
+                else:
+                    konto_list = sorted(huvudbok.results)
+                for cell_konto in konto_list:
+                    konto_section = huvudbok.sections.find(int(cell_konto))
+                    section_name = konto_section and konto_section.name
+                    if section and section != section_name:
+                        continue
+                    values = huvudbok.results[cell_konto]
+                    ks_list = [ks] if ks else sorted(values)
+                    for cell_ks in ks_list:
+                        value = values.get(cell_ks)
+                        if not value:
+                            continue
+                        total += value
+                        cells.append({
+                            'file': book_file,
+                            'year': book_year,
+                            'konto': cell_konto,
+                            'namn': huvudbok.all_konto.get(cell_konto),
+                            'section': section_name,
+                            'ks': cell_ks,
+                            'projekt': projects.get(cell_ks),
+                            'belopp': format_ore(value),
+                        })
+        return {'cells': cells, 'total': format_ore(total)}
+
+    def status(self):
+        """Return the loaded files along with their years."""
+        return {
+            'files': [
+                {'file': filename,
+                 'years': sorted(self.books[filename]),
+                 'loaded': self.loaded[filename]}
+                for filename in self.filenames]}
+
+
+class LedgerRequestHandler(BaseHTTPRequestHandler):
+    """Answer the queries of the API, see the module docstring."""
+
+    ledger = None  # the Ledger to query, set by serve
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        params = {
+            key: values[0] for key, values in parse_qs(url.query).items()}
+        try:
+            self.ledger.refresh()
+            if url.path == '/query':
+                self.send_json(200, self.ledger.query(
+                    params.get('konto'), params.get('ks'),
+                    params.get('section'), params.get('year'),
+                    params.get('file')))
+            elif url.path == '/projects':
+                self.send_json(200, {'names': [
+                    {'year': year, 'name': name}
+                    for year, name in PROJECTS.history(params.get('ks'))]})
+            elif url.path == '/status':
+                self.send_json(200, self.ledger.status())
+            else:
+                self.send_json(404, {'error': 'Unknown path: ' + url.path})
+        except (OSError, ValueError, KeyError, IndexError, TypeError) as e:
+            self.send_json(500, {'error': str(e)})
+
+    def send_json(self, status, data):
+        """Send a json response."""
+        body = json.dumps(data, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(ledger, host='127.0.0.1', port=8000):
+    """Answer queries on the ledger until interrupted."""
+    LedgerRequestHandler.ledger = ledger
+    server = ThreadingHTTPServer((host, port), LedgerRequestHandler)
+    print('Serving {} on http://{}:{}/'.format(
+        ', '.join(ledger.filenames), host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Answer queries on Fortnox huvudbok exports over HTTP.')
+    parser.add_argument(
+        '--port',
+        help='Port to listen on. Defaults to 8000.',
+        type=int,
+        default=8000
+    )
+    parser.add_argument(
+        '--host',
+        help='Address to listen on. Defaults to 127.0.0.1, local only.',
+        default='127.0.0.1'
+    )
+    parser.add_argument(
+        '--years',
+        help='Years to crunch. If not given, every year found is crunched.',
+        nargs='+'
+    )
+    parser.add_argument(
+        'data_files',
+        help='Paths to Fortnox huvudbok .txt output files.',
+        nargs='+',
+    )
+    args = parser.parse_args()
+    serve(Ledger(args.data_files, args.years), args.host, args.port)
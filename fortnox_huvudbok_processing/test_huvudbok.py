@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+"""Tests for huvudbok.py.
+
+python -m pytest fortnox_huvudbok_processing
+"""
+import shutil
+
+import pytest
+
+from generate_huvudbok import generate
+from huvudbok import Huvudbok
+
+YEAR = '2018'  # a year with merge rules
+
+
+@pytest.fixture(scope='module')
+def export(tmp_path_factory):
+    """A synthetic Fortnox output file."""
+    filename = str(tmp_path_factory.mktemp('export') / 'huvudbok.txt')
+    generate(filename, konto=60, ks=15, rows=5000, years=[YEAR, '2019'])
+    return filename
+
+
+def crunch(export, directory, layout, engine='dict', jobs=1):
+    """Crunch a copy of the export in directory, return the output."""
+    directory.mkdir()
+    filename = str(directory / 'huvudbok.txt')
+    shutil.copy(export, filename)
+    Huvudbok(filename, YEAR, layout, engine=engine, jobs=jobs)
+    out_name = '{}_crunched{}.tsv'.format(
+        Huvudbok.get_basename(filename), Huvudbok.LAYOUTS[layout])
+    with open(out_name, 'rb') as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('layout', ['basic', 'fancy'])
+@pytest.mark.parametrize('engine, jobs', [
+    ('numpy', 1), ('dict', 3), ('numpy', 3)])
+def test_same_output(export, tmp_path, layout, engine, jobs):
+    """The engines give the same output, in one process or several."""
+    if engine == 'numpy':
+        pytest.importorskip('numpy')
+    expected = crunch(export, tmp_path / 'reference', layout)
+    assert expected
+    assert crunch(export, tmp_path / engine, layout, engine, jobs) == expected
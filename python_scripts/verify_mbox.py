@@ -4,49 +4,555 @@
 Each missing message has its id printed to stdout and the message is
 saved to missing.mbox. Ignores the parameter X-GM-THRID.
 
+Memory use grows with the number of messages, not with their size:
+`mbox2` is indexed as Message-ID -> (offset, length, digest) and `mbox1` is
+streamed against the index, one message at a time. Only the fingerprints of
+`mbox1` are kept while streaming, to write its index file, and not even
+those with `--no-index`. Both files are memory mapped and split on their
+raw bytes, only the messages to write are parsed as email.
+With `--workers`, the files are cut into ranges of whole messages which are
+fingerprinted by a pool of processes.
+
+The fingerprints of each file are kept in an index file next to it, named
+like the file with a .fingerprints suffix, so files which are unchanged or
+only appended to since last verified are not read again.
+
+With `--reconcile OUTPUT_DIR`, any number of mbox files are reconciled in
+one pass over each: the messages missing from each file and those of which
+the files have conflicting versions are written to mbox files per file in
+OUTPUT_DIR, along with a summary.json.
+
+Messages are compared by a digest of their normalized headers, leaving out
+X-GM-THRID and any other headers given by `--ignore-header`, and their body
+with line endings normalized to LF. Messages without a Message-ID are
+matched on their Date, From and Subject headers instead.
+
 Requirements:
 * tqdm>=4.64.0,==4.*
 """
 
 from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
 import mailbox
+import mmap
+import os
+import pickle
+import re
+import time
+import zlib
 
 from tqdm import tqdm
 
+# Headers added by Groups, which differ between exports.
+IGNORED_HEADERS = (b"x-gm-thrid",)
+# Headers identifying a message without a Message-ID.
+FALLBACK_KEY_HEADERS = (b"date", b"from", b"subject")
+# Size of the ranges of an mbox file fingerprinted in parallel.
+CHUNK_SIZE = 16 * 1024 * 1024
+# Suffix and version of the fingerprint index kept next to an mbox file.
+INDEX_SUFFIX = ".fingerprints"
+INDEX_VERSION = 2
+# Bytes at the head and at the tail of an mbox file checked against its
+# index.
+CHECKSUM_SIZE = 64 * 1024
+# The empty line ending the headers of a message.
+HEADER_END = re.compile(rb"\r?\n\r?\n")
+# Size of the slices of a message body hashed at a time.
+BODY_SLICE_SIZE = 1024 * 1024
+
+
+def map_file(path):
+    """Memory map a file for reading, empty files can not be mapped."""
+    with open(path, "rb") as f:
+        if not os.fstat(f.fileno()).st_size:
+            return b""
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def iter_messages(path, start=0, end=None):
+    """Yield the offset and raw bytes of each message in an mbox file.
+
+    The file is memory mapped and split on "From " lines just like
+    `mailbox.mbox` does, each message starting with its "From " line. The
+    messages are given as memoryview slices of the map, without copying.
+
+    @param start: offset to start at, any message started before it is
+        left out
+    @param end: offset to stop at, which should be the start of a message
+        or the end of the file
+    """
+    data = map_file(path)
+    view = memoryview(data)
+    end = len(data) if end is None else end
+    if not (start == 0 and data[:5] == b"From "):
+        start = data.find(b"\nFrom ", max(start - 1, 0), end) + 1
+        if not start:
+            return
+    while True:
+        next_start = data.find(b"\nFrom ", start, end) + 1
+        stop = next_start or end
+        if data[stop - 2:stop] == b"\n\n":
+            stop -= 1  # the empty line separating the messages
+        yield start, view[start:stop]
+        if not next_start:
+            break
+        start = next_start
+
+
+def split_ranges(path, start=0, size=CHUNK_SIZE):
+    """Cut an mbox file, from start on, into ranges of about size bytes.
+
+    Each range starts at the start of a message, so the messages of the
+    file are those of the ranges, in order.
+
+    @return: list of (start, end) offsets
+    """
+    data = map_file(path)
+    starts = [start]
+    for offset in range(start + size, len(data), size):
+        if offset > starts[-1]:
+            start = data.find(b"\nFrom ", offset - 1) + 1
+            if not start:
+                break
+            starts.append(start)
+    return list(zip(starts, starts[1:] + [len(data)]))
+
+
+def fingerprint_range(path, start, end, ignored_headers=IGNORED_HEADERS):
+    """Fingerprint the messages of an mbox file between two offsets.
+
+    Run by the worker processes, see `split_ranges`.
+
+    @return: list of (offset, length, key, digest)
+    """
+    return [(offset, len(data)) + fingerprint(data, ignored_headers)
+            for offset, data in iter_messages(path, start, end)]
+
+
+def fingerprint_mbox(path, ignored_headers=IGNORED_HEADERS, executor=None,
+                     progress=None, start=0):
+    """Yield the offset, length, key and digest of each message, in order.
+
+    @param executor: the executor fingerprinting the ranges of the file in
+        parallel, if not given they are fingerprinted one at a time
+    @param progress: tqdm progress bar, updated by the bytes of each range
+        as it is done
+    @param start: offset of the first message to fingerprint
+    """
+    ranges = split_ranges(path, start)
+    arguments = ([path] * len(ranges), [start for start, _end in ranges],
+                 [end for _start, end in ranges],
+                 [ignored_headers] * len(ranges))
+    if executor is None:
+        results = map(fingerprint_range, *arguments)
+    else:
+        results = executor.map(fingerprint_range, *arguments)
+    for (start, end), entries in zip(ranges, results):
+        if progress is not None:
+            progress.update(end - start)
+        yield from entries
+
+
+def split_message(message):
+    """Split a raw message into its header block and body.
+
+    The "From " line is left out and line endings in the header block are
+    normalized to LF. The body is a slice of message, without any trailing
+    white space.
+    """
+    size = 4096
+    while True:  # copy just enough of the message to find its headers
+        head = bytes(message[:size])
+        header_start = head.find(b"\n") + 1
+        match = HEADER_END.search(head, header_start - 1)
+        if match or size >= len(message):
+            break
+        size *= 4
+    if match is None:
+        header_end = body_start = len(message)
+    else:
+        header_end, body_start = match.span()
+    body_end = len(message)
+    while body_end > body_start and message[body_end - 1] in b" \t\r\n":
+        body_end -= 1
+    header_block = bytes(message[header_start:header_end])
+    return header_block.replace(b"\r\n", b"\n"), message[body_start:body_end]
+
+
+def parse_headers(header_block):
+    """Return the (name, value) of each header in a raw header block.
+
+    Names are lowercased. Values are unfolded, with any runs of white space
+    collapsed into a single space.
+    """
+    headers = []
+    for line in header_block.split(b"\n"):
+        if line[:1] in (b" ", b"\t") and headers:  # a folded line
+            name, value = headers.pop()
+            headers.append((name, value + b" " + line))
+        elif b":" in line:
+            name, value = line.split(b":", 1)
+            headers.append((name.strip().lower(), value))
+    return [(name, b" ".join(value.split())) for name, value in headers]
+
+
+def fingerprint(data, ignored_headers=IGNORED_HEADERS):
+    """Return the key and digest of a raw message.
+
+    The key is the Message-ID or, lacking one, made from the Date, From and
+    Subject headers. The digest covers the normalized headers, in order of
+    name and leaving out ignored_headers, and the body, see
+    `update_body`.
+
+    @return: (key, digest)
+    """
+    header_block, body = split_message(data)
+    headers = parse_headers(header_block)
+    values = dict(headers)
+    if b"message-id" in values:
+        key = values[b"message-id"].decode("ascii", "replace")
+    else:
+        fallback = hashlib.blake2b(digest_size=8)
+        for name in FALLBACK_KEY_HEADERS:
+            fallback.update(values.get(name, b"") + b"\n")
+        key = "<no-message-id:{}>".format(fallback.hexdigest())
+
+    digest = hashlib.blake2b(digest_size=16)
+    for name, value in sorted(headers, key=lambda header: header[0]):
+        if name not in ignored_headers:
+            digest.update(name + b": " + value + b"\n")
+    digest.update(b"\n")
+    update_body(digest, body)
+    return key, digest.digest()
+
+
+def update_body(digest, body):
+    """Update a digest with a raw body, line endings normalized to LF.
+
+    Messages read by `mailbox.mbox` have their line endings normalized, so
+    a message saved with CRLF line endings is the same message. The body is
+    hashed in slices, so only a slice at a time is copied.
+    """
+    carry = b""
+    for start in range(0, len(body), BODY_SLICE_SIZE):
+        chunk = carry + bytes(body[start:start + BODY_SLICE_SIZE])
+        carry = b""
+        if chunk[-1:] == b"\r" and start + BODY_SLICE_SIZE < len(body):
+            chunk, carry = chunk[:-1], b"\r"  # may be followed by LF
+        if b"\r" in chunk:
+            chunk = chunk.replace(b"\r\n", b"\n")
+        digest.update(chunk)
+
+
+def parse_message(data, ignored_headers=IGNORED_HEADERS):
+    """Parse a raw message, as read by `mailbox.mbox`.
+
+    Only needed for the messages to write, leaving out ignored_headers.
+    """
+    from_line, _, message = data.partition(b"\n")
+    message = mailbox.mboxMessage(
+        message.replace(os.linesep.encode(), b"\n"))
+    message.set_from(from_line[5:].decode("ascii"))
+    for header in ignored_headers:
+        del message[header.decode()]
+    return message
+
+
+def checksums(data, size):
+    """Return checksums of the head and of the tail of a mapped file.
+
+    @param size: the size of the file to check, which may have grown since
+    """
+    head = data[:min(size, CHECKSUM_SIZE)]
+    tail = data[max(size - CHECKSUM_SIZE, 0):size]
+    return (hashlib.blake2b(head, digest_size=16).digest(),
+            hashlib.blake2b(tail, digest_size=16).digest())
+
+
+def read_index(path):
+    """Read an index file, return None if missing or broken."""
+    try:
+        with open(path, "rb") as f:
+            return pickle.loads(zlib.decompress(f.read()))
+    except (OSError, EOFError, zlib.error, pickle.UnpicklingError):
+        return None
+
+
+def write_index(path, state):
+    """Write an index file, replacing it atomically."""
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "wb") as f:
+        f.write(zlib.compress(pickle.dumps(state, pickle.HIGHEST_PROTOCOL)))
+    os.replace(tmp_path, path)
+
+
+def load_fingerprints(path, ignored_headers=IGNORED_HEADERS, executor=None,
+                      progress=None, use_index=True):
+    """Yield the offset, length, key and digest of each message, in order.
+
+    The fingerprints are kept in an index file next to the mbox file, which
+    is used for as long as the size, modification time and head and tail
+    checksums of the mbox file are unchanged. If the mbox file has only been
+    appended to, just the new messages are fingerprinted. The index file is
+    written once the last message has been yielded.
+
+    See `fingerprint_mbox` for executor and progress.
+
+    @param use_index: False to neither read nor write the index file
+    """
+    stat = os.stat(path)
+    data = map_file(path)
+    cached = []
+    start = 0
+    state = read_index(path + INDEX_SUFFIX) if use_index else None
+    if (state is not None and state["version"] == INDEX_VERSION
+            and state["ignored_headers"] == sorted(ignored_headers)
+            and checksums(data, state["size"]) == state["checksums"]):
+        if (state["size"], state["mtime_ns"]) == (len(data),
+                                                  stat.st_mtime_ns):
+            if progress is not None:
+                progress.update(len(data))
+            yield from state["entries"]
+            return
+        if state["size"] < len(data):
+            # Appended to, fingerprint the last message again as it may
+            # have grown.
+            cached = state["entries"]
+            if cached:
+                start = cached.pop()[0]
+
+    if progress is not None:
+        progress.update(start)
+    yield from cached
+    entries = cached  # the fingerprints to write to the index file
+    for entry in fingerprint_mbox(path, ignored_headers, executor, progress,
+                                  start):
+        if use_index:
+            entries.append(entry)
+        yield entry
+    if use_index:
+        try:
+            write_index(path + INDEX_SUFFIX, {
+                "version": INDEX_VERSION,
+                "ignored_headers": sorted(ignored_headers),
+                "size": len(data),
+                "mtime_ns": stat.st_mtime_ns,
+                "checksums": checksums(data, len(data)),
+                "entries": entries,
+            })
+        except OSError as e:
+            tqdm.write("Could not write index of {}: {}".format(path, e))
+
+
+def index_mbox(path, ignored_headers=IGNORED_HEADERS, executor=None,
+               progress=None, use_index=True):
+    """Index an mbox file as key -> (offset, length, digest).
+
+    See `load_fingerprints` for executor, progress and use_index.
+    """
+    return {key: (offset, length, digest)
+            for offset, length, key, digest in load_fingerprints(
+                path, ignored_headers, executor, progress, use_index)}
+
+
+def verify(path1, path2, missing_path="missing.mbox",
+           ignored_headers=IGNORED_HEADERS, workers=1, use_index=True):
+    """Write the messages of path1 missing from or different in path2.
+
+    Each such message is written to missing_path as soon as it is found.
+
+    @param workers: number of processes fingerprinting the messages, the
+        files are fingerprinted in this process if 1
+    @param use_index: False to neither read nor write the index files of
+        the mbox files
+    @return: the number of missing or different messages
+    """
+    size = os.path.getsize(path1) + os.path.getsize(path2)
+    executor = ProcessPoolExecutor(workers) if workers > 1 else None
+    box_missing = None
+    missing = 0
+    start = time.perf_counter()
+    progress = tqdm(total=size, unit="B", unit_scale=True)
+    with progress:
+        index = index_mbox(
+            path2, ignored_headers, executor, progress, use_index)
+        data = map_file(path1)
+        for offset, length, key, digest in load_fingerprints(
+                path1, ignored_headers, executor, progress, use_index):
+            entry = index.get(key)
+            if entry is not None and entry[2] == digest:
+                continue
+
+            # Save message if it's in the first mailbox, but not the
+            # second, or if its content differs.
+            if box_missing is None:
+                tqdm.write("Messages missing from or different in second "
+                           "mbox:")
+                box_missing = mailbox.mbox(missing_path)
+            tqdm.write(key)
+            box_missing.add(parse_message(
+                data[offset:offset + length], ignored_headers))
+            missing += 1
+    if executor is not None:
+        executor.shutdown()
+    seconds = time.perf_counter() - start
+    print("Compared {:.1f} MB in {:.1f} s, {:.1f} MB/s.".format(
+        size / 1e6, seconds, size / 1e6 / seconds))
+
+    if box_missing is not None:
+        box_missing.close()
+        print("Messages written to {}.".format(missing_path))
+    return missing
+
+
+def add_message(boxes, path, message):
+    """Add a message to the mbox file at path, emptied when first opened.
+
+    @param boxes: the opened mbox files, path -> `mailbox.mbox`
+    """
+    if path not in boxes:
+        if os.path.exists(path):
+            os.remove(path)
+        boxes[path] = mailbox.mbox(path)
+    boxes[path].add(message)
+
+
+def reconcile(paths, output_dir="reconciled",
+              ignored_headers=IGNORED_HEADERS, workers=1, use_index=True):
+    """Reconcile the messages of any number of mbox files.
+
+    Each file is fingerprinted once, into one index of key -> digest ->
+    the files having that version of the message. Then, for each file, the
+    messages it lacks are written to output_dir/N-NAME.missing.mbox and its
+    messages of which another file has a different version are written to
+    output_dir/N-NAME.conflicts.mbox, N being the number of the file. A
+    summary of it all is written to output_dir/summary.json.
+
+    See `verify` for workers and use_index.
+
+    @return: the summary
+    """
+    size = sum(os.path.getsize(path) for path in paths)
+    executor = ProcessPoolExecutor(workers) if workers > 1 else None
+    versions = {}  # key: {digest: {source: (offset, length)}}
+    summary = {
+        "sources": [{"path": path, "messages": 0, "missing": [],
+                     "conflicts": [], "missing_mbox": None,
+                     "conflicts_mbox": None} for path in paths],
+        "messages": 0,
+        "present_everywhere": 0,
+        "conflicts": [],
+    }
+    start = time.perf_counter()
+    with tqdm(total=size, unit="B", unit_scale=True) as progress:
+        for source, path in enumerate(paths):
+            for offset, length, key, digest in load_fingerprints(
+                    path, ignored_headers, executor, progress, use_index):
+                versions.setdefault(key, {}).setdefault(
+                    digest, {}).setdefault(source, (offset, length))
+                summary["sources"][source]["messages"] += 1
+    if executor is not None:
+        executor.shutdown()
+    seconds = time.perf_counter() - start
+    print("Compared {:.1f} MB in {:.1f} s, {:.1f} MB/s.".format(
+        size / 1e6, seconds, size / 1e6 / seconds))
+
+    os.makedirs(output_dir, exist_ok=True)
+    names = [os.path.join(output_dir, "{}-{}".format(
+        source + 1, os.path.basename(path))) for source, path in
+        enumerate(paths)]
+    datas = [map_file(path) for path in paths]
+    boxes = {}
+    summary["messages"] = len(versions)
+    for key, key_versions in versions.items():
+        sources = set()
+        for located in key_versions.values():
+            sources.update(located)
+        if len(key_versions) > 1:
+            summary["conflicts"].append({"key": key, "versions": [
+                {"digest": digest.hex(),
+                 "sources": [paths[source] for source in sorted(located)]}
+                for digest, located in key_versions.items()]})
+            for located in key_versions.values():
+                for source, (offset, length) in located.items():
+                    add_message(
+                        boxes, names[source] + ".conflicts.mbox",
+                        parse_message(datas[source][offset:offset + length],
+                                      ignored_headers))
+                    summary["sources"][source]["conflicts"].append(key)
+        elif len(sources) == len(paths):
+            summary["present_everywhere"] += 1
+
+        for source in range(len(paths)):
+            if source in sources:
+                continue
+            # Write each version of the message, as found in the first file
+            # having it.
+            for located in key_versions.values():
+                other, (offset, length) = min(located.items())
+                add_message(
+                    boxes, names[source] + ".missing.mbox",
+                    parse_message(datas[other][offset:offset + length],
+                                  ignored_headers))
+            summary["sources"][source]["missing"].append(key)
+
+    for box in boxes.values():
+        box.close()
+    for source, name in enumerate(names):
+        for kind in ("missing", "conflicts"):
+            if name + "." + kind + ".mbox" in boxes:
+                summary["sources"][source][kind + "_mbox"] = (
+                    name + "." + kind + ".mbox")
+    summary_path = os.path.join(output_dir, "summary.json")
+    with open(summary_path, "w", encoding="utf-8") as f:
+        json.dump(summary, f, indent=2, ensure_ascii=False)
+
+    print("{} messages, {} in every mbox, {} with conflicting versions."
+          .format(summary["messages"], summary["present_everywhere"],
+                  len(summary["conflicts"])))
+    for source in summary["sources"]:
+        print("{}: {} messages, {} missing, {} conflicting.".format(
+            source["path"], source["messages"], len(source["missing"]),
+            len(source["conflicts"])))
+    print("Summary written to {}.".format(summary_path))
+    return summary
+
 
-parser = ArgumentParser()
-parser.add_argument("mbox1")
-parser.add_argument("mbox2")
-args = parser.parse_args()
-
-box1 = mailbox.mbox(args.mbox1, create=False)
-box2 = mailbox.mbox(args.mbox2, create=False)
-
-messages2 = {m["Message-ID"]: m for m in box2}
-
-missing = []
-
-for message1 in tqdm(box1):
-    # Remove extra parameter added by Groups.
-    del message1["X-GM-THRID"]
-    message2 = messages2.get(message1["Message-ID"])
-    if message2 is None:
-        # Save message if it's in the first mailbox, but not the
-        # second.
-        missing.append(message1)
-        continue
-
-    del message2["X-GM-THRID"]
-    if str(message1).strip() != str(message2).strip():
-        # Check complete messages content if the id matches. Save
-        # message if there are inconsistencies.
-        missing.append(message1)
-
-if missing:
-    print("Messages missing from or different in second mbox:")
-    box_missing = mailbox.mbox("missing.mbox")
-    for message in missing:
-        print(message["Message-ID"])
-        box_missing.add(message)
-    box_missing.close()
-    print("Messages written to missing.mbox.")
+if __name__ == "__main__":
+    parser = ArgumentParser()
+    parser.add_argument("mbox1")
+    parser.add_argument("mbox2")
+    parser.add_argument(
+        "more_mboxes", nargs="*", metavar="mbox",
+        help="More mbox files to reconcile, only with --reconcile.")
+    parser.add_argument(
+        "--ignore-header", action="append", default=[], metavar="HEADER",
+        help="Also leave out this header when comparing messages. Can be "
+             "given several times.")
+    parser.add_argument(
+        "--workers", "-w", type=int, default=1,
+        help="Number of processes fingerprinting the messages, in ranges of "
+             "{} MB. Defaults to 1.".format(CHUNK_SIZE // 2**20))
+    parser.add_argument(
+        "--reconcile", metavar="OUTPUT_DIR",
+        help="Reconcile all of the mbox files instead, writing the missing "
+             "and conflicting messages of each file and a summary.json to "
+             "OUTPUT_DIR.")
+    parser.add_argument(
+        "--no-index", action="store_true",
+        help="Neither read nor write the {} index files kept next to the "
+             "mbox files.".format(INDEX_SUFFIX))
+    args = parser.parse_args()
+    ignored_headers = IGNORED_HEADERS + tuple(
+        header.lower().encode() for header in args.ignore_header)
+    if args.reconcile:
+        reconcile([args.mbox1, args.mbox2] + args.more_mboxes,
+                  args.reconcile, ignored_headers, args.workers,
+                  not args.no_index)
+    elif args.more_mboxes:
+        parser.error("more than two mbox files need --reconcile")
+    else:
+        verify(args.mbox1, args.mbox2, ignored_headers=ignored_headers,
+               workers=args.workers, use_index=not args.no_index)